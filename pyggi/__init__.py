@@ -55,11 +55,24 @@ def create_app(**kwargs):
     import lib.filters
     app.jinja_env.filters['dateformat'] = lib.filters.format_datetime
     app.jinja_env.filters['diffformat'] = lib.filters.format_diff
+    app.jinja_env.filters['patchformat'] = lib.filters.format_patch
     app.jinja_env.filters['timesince'] = lib.filters.humanize_timesince
     app.jinja_env.filters['force_unicode'] = lib.filters.force_unicode
     app.jinja_env.filters['first_line'] = lib.filters.first_line
     app.jinja_env.tests['text'] = lib.filters.is_text
+    app.jinja_env.tests['sha'] = lib.filters.is_sha
     app.context_processor(lambda: dict(static_url_for=lib.filters.static_url_for))
 
+    # scan the repositories in the background, so that the first
+    # request after a start doesn't have to wait for it. this is done
+    # by every worker, as the workers might be forked after this
+    if config.has_option('index', 'warm_up') and config.getboolean('index', 'warm_up'):
+        from pyggi.lib.repository.index import warm_up
+        base = config.get('general', 'git_repositories')
+
+        @app.before_request
+        def start_warm_up():
+            warm_up(base)
+
     return app
 
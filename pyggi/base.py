@@ -9,7 +9,7 @@ import functools
 
 from pyggi.lib.decorators import templated
 import pyggi.lib.filters
-from flask import Blueprint, redirect
+from flask import Blueprint, redirect, url_for, jsonify
 
 base = Blueprint('base', __name__)
 get = functools.partial(base.route, methods=['GET'])
@@ -24,3 +24,12 @@ def favicon():
 def not_found():
     pass
 
+
+@get("/cache-stats")
+def cache_stats():
+    from pyggi.lib.config import config
+    if not (config.has_option('cache', 'stats') and config.getboolean('cache', 'stats')):
+        return redirect(url_for('base.not_found'))
+
+    from pyggi.lib.cache import get_cache
+    return jsonify(get_cache().stats())
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""
+    :copyright: (c) 2011 by Tobias Heinzen
+    :license: BSD, see LICENSE for more details
+"""
+
+import os, os.path
+import errno
+import tempfile
+import logging
+from pyggi.lib.config import config
+
+class ArchiveCache(object):
+    """
+        a directory of archives, stored as '<repository>/<id>.<format>'.
+
+        archives of a commit never change, so they are created once and
+        served from disk afterwards. the directory is limited to <max_size>
+        bytes, the least recently served archives are removed first.
+        archives that were served in the last <grace> seconds are kept, as
+        they might be about to be sent.
+    """
+
+    # number of lock files, which are shared by all archives
+    locks = 256
+
+    def __init__(self, directory, max_size, grace=300):
+        self.directory = directory
+        self.max_size = max_size
+        self.grace = grace
+
+    def path(self, repository, id, format):
+        return os.path.join(self.directory, repository, "%s.%s" % (id, format))
+
+    def _lock_path(self, path):
+        # lock files are never removed, as other processes might hold
+        # them. so there is a fixed number of them
+        import zlib
+        if not isinstance(path, bytes):
+            path = path.encode('utf-8')
+        return os.path.join(self.directory, "%02x.lock" % ((zlib.crc32(path) & 0xffffffff) % self.locks))
+
+    def get(self, repository, id, format, create):
+        """
+            return the path of the archive of commit <id> in <repository>.
+            if the archive is not yet in the cache, <create> is called and
+            the chunks it returns are written to the cache. concurrent
+            requests for the same archive wait for the first one, so the
+            archive is only created once.
+        """
+        path = self.path(repository, id, format)
+        if self._touch(path):
+            return path
+
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        import fcntl
+        with open(self._lock_path(path), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # somebody else might have created the archive while
+                # we were waiting for the lock
+                if self._touch(path):
+                    return path
+
+                fd, temp = tempfile.mkstemp(suffix=".tmp", dir=directory)
+                try:
+                    with os.fdopen(fd, "wb") as fp:
+                        for chunk in create():
+                            fp.write(chunk)
+                    os.rename(temp, path)
+                except:
+                    os.unlink(temp)
+                    raise
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        self.evict(keep=path)
+        return path
+
+    @staticmethod
+    def _touch(path):
+        # the modification time is used as time of last access
+        try:
+            os.utime(path, None)
+            return True
+        except OSError:
+            return False
+
+    def evict(self, keep=None):
+        """
+            remove the least recently used archives until the cache
+            is smaller than its maximum size. the archive <keep> and
+            recently served archives are never removed.
+        """
+        import time
+        recent = time.time() - self.grace
+
+        entries = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith(".tmp") or filename.endswith(".lock"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size or mtime > recent:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError as e:
+                logging.warning("could not remove archive '%s': %s", path, e)
+
+_archive_cache = None
+
+def get_archive_cache():
+    """
+        return the archive cache of this process or None if
+        archives shall not be cached
+    """
+    global _archive_cache
+    if _archive_cache is None and config.has_option('archive', 'directory'):
+        max_size = 1024
+        if config.has_option('archive', 'max_size'):
+            max_size = config.getint('archive', 'max_size')
+
+        _archive_cache = ArchiveCache(config.get('archive', 'directory'), max_size * 1024 * 1024)
+    return _archive_cache
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+
+"""
+    :copyright: (c) 2011 by Tobias Heinzen
+    :license: BSD, see LICENSE for more details
+"""
+
+import time
+import threading
+import logging
+from collections import OrderedDict
+from pyggi.lib.config import config
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+class DummyCache(object):
+    def get(*args, **kwargs):
+        pass
+    def set(*args, **kwargs):
+        pass
+    def add(*args, **kwargs):
+        return True
+    def inc(*args, **kwargs):
+        pass
+    def delete(*args, **kwargs):
+        pass
+    def stats(*args, **kwargs):
+        return dict(enabled=False)
+
+class LocalCache(object):
+    """
+        a cache in the memory of the process, holding at most <max_size>
+        bytes of pickled values. the least recently used values are
+        removed first. a timeout of 0 never expires.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remove(self, key):
+        expires, data = self._entries.pop(key)
+        self.size -= len(key) + len(data)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] < time.time():
+                self.size -= len(key) + len(entry[1])
+                return None
+            self._entries[key] = entry
+        return pickle.loads(entry[1])
+
+    def _store(self, key, data, timeout):
+        # has to be called with the lock held
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.time() + timeout if timeout else None, data)
+        self.size += len(key) + len(data)
+        while self.size > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def set(self, key, value, timeout=0):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(key) + len(data) > self.max_size:
+            # too large for the cache at all
+            self.delete(key)
+            return False
+
+        with self._lock:
+            self._store(key, data, timeout)
+        return True
+
+    def add(self, key, value, timeout=0):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(key) + len(data) > self.max_size:
+            return False
+
+        # the check and the insert are one step, values like locks
+        # must only be added by one thread
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] >= time.time()):
+                return False
+            self._store(key, data, timeout)
+        return True
+
+    def inc(self, key, delta=1):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < time.time()):
+                return None
+            value = pickle.loads(entry[1]) + delta
+            self._remove(key)
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            self._entries[key] = (entry[0], data)
+            self.size += len(key) + len(data)
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+class TieredCache(object):
+    """
+        a LocalCache in front of a cache that is shared by all processes
+        (or None). values are looked up locally first and are stored in
+        both tiers.
+
+        if the shared cache fails, it is left alone for <retry> seconds
+        and only the local cache is used in the meantime.
+
+        a timeout of 0 keeps a value until it's evicted. shared caches
+        get the longest timeout memcached allows instead, because not
+        every backend knows about 0.
+    """
+
+    # 30 days, longer timeouts are taken as a point in time by memcached
+    max_timeout = 30 * 24 * 3600
+
+    def __init__(self, local, shared=None, default_timeout=300, retry=30):
+        self.local = local
+        self.shared = shared
+        self.default_timeout = default_timeout
+        self.retry = retry
+        self._down_until = 0
+        self._lock = threading.Lock()
+        self.counters = dict(local_hits=0, shared_hits=0, misses=0, sets=0, rejected=0, errors=0)
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _shared(self):
+        if self.shared is None or self._down_until > time.time():
+            return None
+        return self.shared
+
+    def _failed(self, e):
+        self._count('errors')
+        if self._down_until <= time.time():
+            logging.warning("shared cache failed, using the local cache for %d seconds: %s", self.retry, e)
+        self._down_until = time.time() + self.retry
+
+    def _call(self, method, *args, **kwargs):
+        """
+            call <method> of the shared cache. returns None if the shared
+            cache isn't available or failed
+        """
+        shared = self._shared()
+        if shared is None:
+            return None
+        try:
+            return getattr(shared, method)(*args, **kwargs)
+        except Exception as e:
+            self._failed(e)
+            return None
+
+    def _timeout(self, timeout):
+        return self.default_timeout if timeout is None else timeout
+
+    def _shared_timeout(self, timeout):
+        return timeout or self.max_timeout
+
+    def get(self, key, local=True):
+        """
+            return the value of <key> or None. if <local> is False, the
+            value is taken from the shared cache, unless it's not available
+        """
+        if local or self._shared() is None:
+            value = self.local.get(key)
+            if value is not None:
+                self._count('local_hits')
+                return value
+
+        value = self._call('get', key)
+        if value is not None:
+            self._count('shared_hits')
+            if local:
+                self.local.set(key, value, self.default_timeout)
+            return value
+
+        self._count('misses')
+        return None
+
+    def set(self, key, value, timeout=None, local=True):
+        """
+            store <value> under <key>. if <local> is False, the value is
+            only stored locally if the shared cache is not available
+        """
+        timeout = self._timeout(timeout)
+        self._count('sets')
+        if local or self._shared() is None:
+            self.local.set(key, value, timeout)
+
+        result = self._call('set', key, value, timeout=self._shared_timeout(timeout))
+        if result is not None and not result:
+            # memcached rejects values above its item size like this, so
+            # this doesn't tell whether the shared cache is down
+            self._count('rejected')
+
+    def add(self, key, value, timeout=None):
+        """
+            store <value> only if <key> is not yet in the cache. returns
+            True if the value was stored.
+        """
+        timeout = self._timeout(timeout)
+        if self._shared() is None:
+            return self.local.add(key, value, timeout)
+
+        result = self._call('add', key, value, timeout=self._shared_timeout(timeout))
+        if result is None:
+            # the shared cache just failed
+            return self.local.add(key, value, timeout)
+        if result:
+            self.local.set(key, value, timeout)
+        return bool(result)
+
+    def inc(self, key, delta=1):
+        """
+            increment the number stored under <key> (see add) by <delta>
+            in one step. returns the new number, or None.
+        """
+        if self._shared() is None:
+            return self.local.inc(key, delta)
+
+        result = self._call('inc', key, delta=delta)
+        if result is None:
+            # the shared cache just failed
+            return self.local.inc(key, delta)
+        self.local.delete(key)
+        return result
+
+    def delete(self, key):
+        self.local.delete(key)
+        self._call('delete', key)
+
+    def stats(self):
+        """
+            return a dictionary with the counters of the cache and the
+            state of its tiers
+        """
+        with self._lock:
+            result = dict(self.counters)
+        result.update(
+            enabled=True,
+            local_entries=len(self.local),
+            local_size=self.local.size,
+            local_max_size=self.local.max_size,
+            shared=self.shared.__class__.__name__ if self.shared is not None else None,
+            shared_available=self.shared is not None and self._down_until <= time.time()
+        )
+        return result
+
+def _uris():
+    if not config.has_option('cache', 'uris'):
+        return []
+    return [x.strip() for x in config.get('cache', 'uris').split(",") if not len(x.strip()) == 0]
+
+def create_shared_cache(backend):
+    """
+        return the shared cache <backend> ('memcached', 'redis' or
+        'filesystem') as configured, or None
+    """
+    if backend == 'memcached':
+        from werkzeug.contrib.cache import MemcachedCache
+        return MemcachedCache(_uris())
+
+    if backend == 'redis':
+        from werkzeug.contrib.cache import RedisCache
+        host, _, port = (_uris() or ['localhost'])[0].partition(':')
+        return RedisCache(host, int(port or 6379))
+
+    if backend == 'filesystem':
+        import os, os.path
+        from werkzeug.contrib.cache import FileSystemCache
+        from pyggi.lib.utils import get_index_directory
+
+        directory = os.path.join(get_index_directory(), 'cache')
+        if config.has_option('cache', 'directory'):
+            directory = config.get('cache', 'directory')
+
+        threshold = 10000
+        if config.has_option('cache', 'threshold'):
+            threshold = config.getint('cache', 'threshold')
+        return FileSystemCache(directory, threshold=threshold)
+
+    if backend != 'none':
+        logging.critical("unknown cache backend '%s' - using the local cache only", backend)
+    return None
+
+_cache = None
+
+def get_cache():
+    """
+        return the cache of this process
+    """
+    global _cache
+    if _cache is not None:
+        return _cache
+
+    if not (config.has_option('cache', 'enabled') and config.getboolean('cache', 'enabled')):
+        _cache = DummyCache()
+        return _cache
+
+    local_size = 64
+    if config.has_option('cache', 'local_size'):
+        local_size = config.getint('cache', 'local_size')
+
+    timeout = 800
+    if config.has_option('cache', 'timeout'):
+        timeout = config.getint('cache', 'timeout')
+
+    retry = 30
+    if config.has_option('cache', 'retry'):
+        retry = config.getint('cache', 'retry')
+
+    backend = 'memcached'
+    if config.has_option('cache', 'backend'):
+        backend = config.get('cache', 'backend')
+
+    # in debug mode, only the local cache is used
+    from flask import current_app
+    if current_app and current_app.debug:
+        backend = 'none'
+
+    try:
+        shared = create_shared_cache(backend)
+    except Exception as e:
+        shared = None
+        logging.critical("could not create the %s cache - using the local cache only: %s", backend, e)
+
+    _cache = TieredCache(LocalCache(local_size * 1024 * 1024), shared, timeout, retry)
+    return _cache
+
+def get_timeout(endpoint, default=None):
+    """
+        return the time in seconds a page of <endpoint> is cached, or
+        <default> if it's not configured
+    """
+    if config.has_option('cache_timeouts', endpoint):
+        return config.getint('cache_timeouts', endpoint)
+    return default
@@ -6,6 +6,7 @@
 """
 
 from flask import render_template, request
+import functools
 from functools import wraps
 
 def method_shortcut(application, method='GET'):
@@ -16,7 +17,38 @@ def method_shortcut(application, method='GET'):
         return decorator
     return ruler
 
-def templated(template):
+def stream_template(template, context, buffer_size=16):
+    """
+        render <template> with <context> piece by piece. the pieces are
+        collected into chunks of <buffer_size> template pieces, so the
+        header and menu reach the client while the rest of the page is
+        still rendered.
+    """
+    from flask import current_app
+
+    app = current_app._get_current_object()
+    environ = request.environ
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template).stream(context)
+    stream.enable_buffering(buffer_size)
+
+    def generate():
+        # the request context is gone once the view returned, but the
+        # template still needs it (for url_for and the request)
+        with app.request_context(environ):
+            for chunk in stream:
+                yield chunk
+
+    return app.response_class(generate())
+
+def templated(template, stream=False):
+    """
+        render the context returned by the decorated function with
+        <template>. if <stream> is given, the page is streamed to the
+        client while it's rendered (see stream_template). the function
+        should then look up everything that can fail, because errors
+        can't be turned into a different response once the page started.
+    """
     def decorator(f):
         @wraps(f)
         def template_function(*args, **kwargs):
@@ -46,31 +78,260 @@ def templated(template):
             context['pygglets'] = __pygglets__
 
             # render the context using given template
+            if stream:
+                return stream_template(template, context)
             response = render_template(template, **context)
             return response
 
         return template_function
     return decorator
 
+_template_version = None
+
+def get_template_version():
+    """
+        return a string that changes whenever the templates are changed
+        (or the configured [cache] version)
+    """
+    global _template_version
+    if _template_version is None:
+        import os, os.path, hashlib
+        from pyggi.lib.config import config
+
+        directory = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'templates')
+        stamps = []
+        for name in sorted(os.listdir(directory)):
+            stamps.append((name, os.stat(os.path.join(directory, name)).st_mtime))
+        if config.has_option('cache', 'version'):
+            stamps.append(config.get('cache', 'version'))
+        _template_version = hashlib.sha1(repr(stamps)).hexdigest()[:12]
+    return _template_version
+
 def cached(keyfn):
+    """
+        cache the result of the decorated function under the key that
+        <keyfn> returns for the arguments (nothing is cached if it returns
+        None).
+
+        the key has to change whenever the result would change, so results
+        are kept until they are evicted. a time after which results expire
+        can be configured per function (see pyggi.lib.cache.get_timeout).
+
+        the key (and the version of the templates) is also used as ETag of
+        the response, so clients that have the page already get a '304 Not
+        Modified' before anything is computed. pages that are sent compressed
+        with gzip get an ETag of their own. <keyfn> can have the optional
+        attributes cache_control and last_modified: functions that are
+        called with the arguments and return the Cache-Control header and
+        the date of the last modification (or None).
+
+        only one process computes a missing result at a time (see lease).
+        the others serve the last version of the page, if <keyfn> has the
+        optional attribute stale_key (a function that returns the key under
+        which the last version of the page is kept, or None), or wait for
+        the result.
+    """
     def decorator(f):
         @wraps(f)
         def cache_function(*args, **kwargs):
             key = keyfn(*args, **kwargs)
             if key is None:
-                result = f(*args, **kwargs)
+                return f(*args, **kwargs)
+
+            from flask import current_app
+            import hashlib
+
+            etag = hashlib.sha1((key + "-" + get_template_version()).encode('utf-8')).hexdigest()
+            cache_control = getattr(keyfn, 'cache_control', None)
+            cache_control = cache_control(*args, **kwargs) if cache_control is not None else None
+
+            # the client might have either encoding of the page
+            etags = [etag, etag + "-gz"] if accepts_gzip() else [etag]
+            matched = [tag for tag in etags if request.if_none_match.contains(tag)]
+            if matched:
+                response = current_app.response_class(status=304)
+                etag = matched[0]
             else:
-                from pyggi.lib.utils import cache
-                from pyggi.lib.config import config
-                result = cache.get(key)
-                if result is None:
-                    result = f(*args, **kwargs)
-                    timeout = None
-                    if config.has_option('cache', 'timeout'):
-                        timeout = config.getint('cache','timeout')
-                    cache.set(key, result, timeout=timeout)
-            return result
+                from pyggi.lib.cache import get_cache, get_timeout
+                cache = get_cache()
+                stale_key = getattr(keyfn, 'stale_key', None)
+                stale_key = stale_key(*args, **kwargs) if stale_key is not None else None
+
+                record = cache.get(key)
+                lock = stale = None
+                if not isinstance(record, CachedResponse):
+                    record, stale, lock = lease(cache, key, stale_key)
+
+                if stale is not None:
+                    # the last version of the page doesn't match the ETag
+                    response = stale.response()
+                    response.headers['Cache-Control'] = "public, no-cache"
+                    return response
+
+                if isinstance(record, CachedResponse):
+                    response = record.response()
+                else:
+                    try:
+                        response = current_app.make_response(f(*args, **kwargs))
+                        if response.status_code != 200:
+                            return response
+
+                        timeout = get_timeout(f.__name__, 0)
+                        if response.is_streamed:
+                            # the page is cached once it was sent completely. the
+                            # server closes the response even if it never sent it
+                            response.response = tee(response.response, response, key, timeout, stale_key)
+                            if lock is not None:
+                                response.call_on_close(functools.partial(cache.delete, lock))
+                                lock = None
+                        else:
+                            record = CachedResponse(response.status_code, response.headers, response.data)
+                            store(cache, key, record, timeout, stale_key)
+                            response = record.response()
+                    finally:
+                        if lock is not None:
+                            cache.delete(lock)
+
+                last_modified = getattr(keyfn, 'last_modified', None)
+                if last_modified is not None:
+                    response.last_modified = last_modified(*args, **kwargs)
+
+                if response.headers.get('Content-Encoding') == 'gzip':
+                    etag = etag + "-gz"
+
+            response.vary.add('Accept-Encoding')
+            response.set_etag(etag)
+            if cache_control is not None:
+                response.headers['Cache-Control'] = cache_control
+            return response
 
         return cache_function
     return decorator
 
+def accepts_gzip():
+    return request.accept_encodings['gzip'] > 0
+
+def lease(cache, key, stale_key):
+    """
+        make sure only one process computes the missing value of <key>.
+        return a tuple (record, stale, lock) where at most one is not None:
+
+            record  the value, computed by another process in the meantime
+            stale   the last version of the value (from <stale_key>), to be
+                    used while another process computes the value
+            lock    the key of the lock that was acquired. the caller has
+                    to compute the value and delete the lock afterwards
+
+        if all are None, the value has to be computed without lock, because
+        the other process did not finish in time, or the shared cache can't
+        be reached.
+    """
+    import time
+    from pyggi.lib.config import config
+
+    lock_timeout = 30
+    if config.has_option('cache', 'lock_timeout'):
+        lock_timeout = config.getint('cache', 'lock_timeout')
+
+    wait = 5.0
+    if config.has_option('cache', 'wait'):
+        wait = config.getfloat('cache', 'wait')
+
+    lock = key + "-lock"
+    if cache.add(lock, 1, timeout=lock_timeout):
+        return (None, None, lock)
+
+    # memcached also refuses to add a value if it can't be reached
+    if cache.get(lock, local=False) is None:
+        record = cache.get(key)
+        return (record if isinstance(record, CachedResponse) else None, None, None)
+
+    if stale_key is not None:
+        stale = cache.get(stale_key)
+        if isinstance(stale, CachedResponse):
+            return (None, stale, None)
+
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        time.sleep(0.1)
+        record = cache.get(key)
+        if isinstance(record, CachedResponse):
+            return (record, None, None)
+        if cache.get(lock, local=False) is None:
+            # released without a result (like for errors)
+            break
+    return (None, None, None)
+
+def store(cache, key, record, timeout, stale_key=None):
+    """
+        store <record> under <key> and as last version under <stale_key>
+    """
+    cache.set(key, record, timeout=timeout)
+    if stale_key is not None:
+        cache.set(stale_key, record, timeout=timeout)
+
+def tee(iterable, response, key, timeout, stale_key=None):
+    """
+        pass the chunks of <iterable>, the body of the streamed <response>,
+        on and store the response in the cache under <key> after the last
+        chunk. nothing is stored if the iteration is aborted.
+    """
+    from pyggi.lib.cache import get_cache
+
+    status, headers, charset = response.status_code, list(response.headers), getattr(response, 'charset', 'utf-8')
+    chunks = []
+    for chunk in iterable:
+        chunks.append(chunk)
+        yield chunk
+
+    body = b"".join(chunk.encode(charset) if isinstance(chunk, unicode) else chunk for chunk in chunks)
+    store(get_cache(), key, CachedResponse(status, headers, body), timeout, stale_key)
+
+class CachedResponse(object):
+    """
+        the status, headers and body of a response, as they are stored in
+        the cache. bodies larger than [cache] compress bytes are stored
+        compressed with gzip, and are sent to clients that accept gzip
+        without decompressing them.
+    """
+
+    # headers that are set per response
+    skipped_headers = set(['content-length', 'content-encoding', 'transfer-encoding', 'etag',
+        'last-modified', 'cache-control', 'vary', 'set-cookie'])
+
+    def __init__(self, status, headers, body):
+        from pyggi.lib.config import config
+
+        self.status = status
+        self.headers = [(name, value) for name, value in headers if name.lower() not in self.skipped_headers]
+
+        threshold = 4096
+        if config.has_option('cache', 'compress'):
+            threshold = config.getint('cache', 'compress')
+
+        self.encoding = None
+        if threshold >= 0 and len(body) > threshold:
+            import zlib
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            self.encoding = 'gzip'
+        self.body = body
+
+    def response(self):
+        """
+            return a response for the current request
+        """
+        from flask import current_app
+
+        body = self.body
+        response = current_app.response_class(status=self.status, headers=self.headers)
+        if self.encoding is not None:
+            response.vary.add('Accept-Encoding')
+            if accepts_gzip():
+                response.headers['Content-Encoding'] = self.encoding
+            else:
+                import zlib
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+        response.data = body
+        return response
@@ -47,11 +47,17 @@ def format_datetime(value, format='iso8601'):
 
     return time.strftime(format, value)
 
-def format_diff(value):
-    # escape HTML, because format_diff shall be used with 'safe'
-    value = unicode(value, 'utf-8') # correct?
-    value = "".join(html_escape_table.get(c,c) for c in value)
+def escape_html(value):
+    """
+        escape the characters of html_escape_table in a whole text at
+        once. '&' has to be replaced first.
+    """
+    value = value.replace("&", "&amp;")
+    for c in ['"', "'", ">", "<"]:
+        value = value.replace(c, html_escape_table[c])
+    return value
 
+def _format_diff_line(value):
     if value.startswith("+") and not value.startswith("+++"):
         return '<li class="diff-add">%s&nbsp;</li>' % value
     elif value.startswith("-") and not value.startswith("---"):
@@ -61,6 +67,19 @@ def format_diff(value):
 
     return '<li>%s</li>' % value
 
+def format_diff(value):
+    # escape HTML, because format_diff shall be used with 'safe'
+    return _format_diff_line(escape_html(force_unicode(value)))
+
+def format_patch(value, skip=2):
+    """
+        format a whole patch as the list items of a <ul>, one for every
+        line, without the first <skip> lines. the patch is escaped in one
+        go, so this shall be used with 'safe' as well.
+    """
+    lines = escape_html(force_unicode(value)).split("\n")[skip:]
+    return "\n".join(_format_diff_line(line) for line in lines)
+
 def humanize_timesince(when):
     import datetime
 
@@ -87,6 +106,13 @@ def humanize_timesince(when):
     else:
         return "%s years ago" % (difference.days / 365)
 
+def is_sha(value):
+    """
+        determine if a tree name is the full id of a commit
+    """
+    from pyggi.lib.repository.refs import sha_regex
+    return sha_regex.match(value) is not None
+
 def is_text(mimetype):
     """
         determine if a mimetype holds printable text (ascii)
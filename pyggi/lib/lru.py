@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+"""
+    :copyright: (c) 2011 by Tobias Heinzen
+    :license: BSD, see LICENSE for more details
+"""
+
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    """
+        a small, thread safe mapping that holds at most <size> entries
+        and evicts the least recently used entry when it's full.
+
+        if <on_evict> is given, it is called with (key, value) for
+        every entry that is removed from the cache by eviction.
+
+        if <weight> is given, it is called with every value and the sum
+        of the weights is kept below <max_weight> as well. values that
+        weigh more than that on their own are not stored.
+    """
+
+    def __init__(self, size=128, on_evict=None, weight=None, max_weight=None):
+        self.size = size
+        self.on_evict = on_evict
+        self.weight = weight
+        self.max_weight = max_weight
+        self._weight = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _weigh(self, value):
+        return self.weight(value) if self.weight is not None else 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                self._weight -= self._weigh(self._entries.pop(key))
+            weight = self._weigh(value)
+            if self.max_weight is not None and weight > self.max_weight:
+                return
+            self._entries[key] = value
+            self._weight += weight
+            while len(self._entries) > self.size or \
+                    (self.max_weight is not None and self._weight > self.max_weight):
+                item = self._entries.popitem(last=False)
+                self._weight -= self._weigh(item[1])
+                evicted.append(item)
+
+        # call the eviction hook outside of the lock, it
+        # might be slow (closing processes, files, ...)
+        if self.on_evict is not None:
+            for item in evicted:
+                self.on_evict(*item)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value = self._entries.pop(key)
+            self._weight -= self._weigh(value)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._weight = 0
@@ -38,7 +38,7 @@ class Pygglet(object):
     def get_repository(self, name):
         from pyggi.lib.utils import get_repository_path
         from pyggi.lib.repository.gitr import GitRepository
-        return GitRepository(repository=get_repository_path(name))
+        return GitRepository.open(get_repository_path(name))
 
     def get_ref(self, repository, tree):
         from pyggi.lib.utils import get_repository_path
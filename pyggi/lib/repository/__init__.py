@@ -112,6 +112,21 @@ class Repository(object):
             last_commit         a Repository.Commit like object that points to the last
                                 commit to this object (see Repository.last_commit)
             is_tree = False
+
+            and the following methods
+
+            stream(start=0, stop=None, chunk_size=65536)
+                                return an iterator over chunks of the bytes
+                                [start, stop) of the data, without loading
+                                all data into memory
+            lines(start=0, stop=None)
+                                return a list of the lines [start, stop) of
+                                the data (0-based, without newlines), without
+                                loading all data into memory
+
+            and the following field
+
+            line_count          the number of lines of the data
         """
         pass
 
@@ -146,6 +161,19 @@ class Repository(object):
 
             is_branch           True if the commit is current head of the active branch
             is_tag              True if the commit has a tag
+            changes             as Commit.diffs, but the field diff of the
+                                Repository.Diff objects is None until their
+                                patches are loaded
+
+            and the following methods
+
+            load_patches(max_files=None, max_lines=None)
+                                load the patches (Diff.diff) of the first
+                                <max_files> changes, but at most <max_lines>
+                                lines. returns the number of loaded patches
+            patch(path)         return the Repository.Diff of the file <path>
+                                with its patch, or None if the commit didn't
+                                change that file
         """
         pass
 
@@ -175,6 +203,15 @@ class Repository(object):
         """
         raise RepositoryError("Abstract Repository")
 
+    @property
+    def decorations(self):
+        """
+            return a dictionary that maps the ids of all commits that are
+                    pointed to by a branch or tag to a list with the names
+                    of these branches and tags
+        """
+        raise RepositoryError("Abstract Repository")
+
     @property
     def is_bare(self):
         """
@@ -229,6 +266,19 @@ class Repository(object):
         """
         raise RepositoryError("Abstract Repository")
 
+    def last_commits(self, tree, path):
+        """
+            return a dictionary that maps the names of all entries in the
+            directory <path> to a Repository.Commit like object of the last
+            commit that changed the entry (see Repository.last_commit). the
+            objects only need the fields id, committed_date, author, summary
+            and message.
+
+            @param tree the reference tree
+            @param path the path of a directory in the repository
+        """
+        raise RepositoryError("Abstract Repository")
+
     def commit_count(self, start):
         """
             @param start the start treeish from where to begin counting
@@ -238,11 +288,28 @@ class Repository(object):
         """
         raise RepositoryError("Abstract Repository")
 
-    def archive(self, treeish):
+    def commit_position(self, start, id):
+        """
+            @param start the start treeish of the history
+            @param id the id of a commit
+
+            return the position of the commit <id> in the list of commits
+                    reachable from <start> (as listed by last_activities),
+                    or -1 if the commit is not reachable
+        """
+        raise RepositoryError("Abstract Repository")
+
+    def archive(self, treeish, format='tar', chunk_size=65536):
         """
             @param  treeish the id of a specific commit
+            @param  format the format of the archive ('tar', 'tar.gz',
+                            'tgz' or 'zip')
+            @param  chunk_size the maximum size of a chunk
 
-            return the data of a 'tar.gz' archive of the specified commit
+            return an iterator over chunks of the archive of the specified
+                    commit. the archive is created while it is iterated, so
+                    it is never held in memory completely. raise a
+                    RepositoryError if the commit does not exist.
         """
         raise RepositoryError("Abstract Repository")
 
@@ -262,9 +329,15 @@ class Repository(object):
         """
         raise RepositoryError("Abstract Repository")
 
-    def last_activities(self, treeish, count=4, skip=0):
+    def last_activities(self, treeish, count=4, skip=0, after=None, paged=False):
         """
             @param treeish from which tree shall the actitivies be listed
+            @param after if given, the list starts with the commit that
+                            follows the commit <after> (<skip> is ignored)
+            @param paged if given, the commits are listed in the same order
+                            as for any other <skip> and <after> (and as by
+                            commit_position), so consecutive pages neither
+                            repeat nor miss commits
 
             return a list of up to <count> Repository.Commit like objects that
                     that are chronologically the last commits to this tree, starting
@@ -302,10 +375,13 @@ class Repository(object):
         """
         raise RepositoryError("Abstract Repository")
 
-    def history(self, path):
+    def history(self, path, count=None, after=None):
         """
             @param path a path in the repository for which the history
                         should be acquired
+            @param count the maximum number of commits, or None for all
+            @param after if given, the list starts with the commit that
+                        follows the commit <after> in the history
 
             return a list of Repository.Commit objects that compose of the
                     history for that path. The list should be sorted such that
@@ -327,6 +403,18 @@ class Repository(object):
         """
         raise RepositoryError("Abstract Repository")
 
+    def blame_incremental(self, path):
+        """
+            @param path a path in the repository for which the blame
+                        information should be acquired
+
+            return an iterator over tuples (commit, line, count) in the
+                    order the blame information is found: the <count> lines
+                    starting at line number <line> (0-based) were changed in
+                    the Repository.Commit like object <commit>.
+        """
+        raise RepositoryError("Abstract Repository")
+
     def tree(self, path):
         """
             @param path a path in the repository for which a tree
@@ -359,6 +447,19 @@ class Repository(object):
         """
         return False
 
+    @staticmethod
+    def summarize(path):
+        """
+            @param path the path of the repository
+
+            return a dictionary with the fields 'description', 'daemon_export',
+                    'head', 'last_date' and 'last_author' that describe the
+                    repository for listings, or None if the path is not a
+                    valid repository. for empty repositories the last three
+                    fields are None.
+        """
+        return None
+
     @staticmethod
     def path(name):
         """
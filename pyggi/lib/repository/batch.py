@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""
+    :copyright: (c) 2011 by Tobias Heinzen
+    :license: BSD, see LICENSE for more details
+"""
+
+import subprocess
+import threading
+
+class CatFile(object):
+    """
+        a pair of long-lived 'git cat-file --batch' and 'git cat-file
+        --batch-check' processes for one repository.
+
+        many objects can be requested at once: all ids are written to the
+        process before the answers are read, so a list of objects costs a
+        single round trip instead of one per object.
+    """
+
+    # number of ids that are written before answers are read. the
+    # ids have to fit into the pipe buffer, otherwise writing would
+    # block while git is waiting for us to read
+    window = 256
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self._processes = {}
+        self._lock = threading.Lock()
+
+    def _process(self, option):
+        process = self._processes.get(option)
+        if process is None or process.poll() is not None:
+            process = subprocess.Popen(
+                ['git', '--git-dir=%s' % self.git_dir, 'cat-file', option],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE
+            )
+            self._processes[option] = process
+        return process
+
+    @staticmethod
+    def _header(process, id):
+        line = process.stdout.readline().decode('ascii').split()
+        if len(line) != 3:
+            # '<id> missing'
+            return None
+        return (line[0], line[1], int(line[2]))
+
+    def _query(self, option, ids, read):
+        result = []
+        with self._lock:
+            process = self._process(option)
+            try:
+                for offset in xrange(0, len(ids), self.window):
+                    window = ids[offset:offset + self.window]
+                    process.stdin.write(''.join(id + '\n' for id in window).encode('ascii'))
+                    process.stdin.flush()
+                    for id in window:
+                        result.append(read(process, id))
+            except:
+                # the state of the process is unknown, start over
+                # the next time
+                self._kill(option)
+                raise
+        return result
+
+    def info(self, ids):
+        """
+            return a list of (id, type, size) tuples for the objects <ids>.
+            an entry is None if the object does not exist.
+        """
+        return self._query('--batch-check', list(ids), self._header)
+
+    def read(self, ids):
+        """
+            return a list of (id, type, data) tuples for the objects <ids>.
+            an entry is None if the object does not exist.
+        """
+        def read_object(process, id):
+            header = self._header(process, id)
+            if header is None:
+                return None
+            data = process.stdout.read(header[2])
+            process.stdout.read(1)
+            return (header[0], header[1], data)
+        return self._query('--batch', list(ids), read_object)
+
+    def _kill(self, option):
+        process = self._processes.pop(option, None)
+        if process is not None:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+
+    def close(self):
+        with self._lock:
+            for option in list(self._processes.keys()):
+                process = self._processes.pop(option)
+                process.stdin.close()
+                process.wait()
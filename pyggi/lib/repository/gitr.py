@@ -6,11 +6,22 @@
 """
 
 import os, os.path
-from git import Repo, GitCommandError
+import logging
+import threading
+import binascii
+import functools
+from git import Repo, Actor, GitCommandError
 from git.exc import BadObject
+from git.objects import Blob, Tree
 from pyggi.lib.repository import Repository, RepositoryError, EmptyRepositoryError
+from pyggi.lib.repository.pool import RepositoryPool, git_dir
+from pyggi.lib.repository import refs
+from pyggi.lib.repository.batch import CatFile
+from pyggi.lib.repository.index import get_last_commit_index, get_commit_list_index, get_blame_index
 from pyggi.lib.config import config
 from pyggi.lib.utils import get_clone_urls
+from pyggi.lib.filters import force_unicode
+from pyggi.lib.lru import LRUCache
 
 class GitRepository(Repository):
     class GitSubmodule(object):
@@ -57,14 +68,22 @@ class GitRepository(Repository):
 
     class GitBranch:
         """emulating Repository.Branch fields"""
-        def __init__(self, branch):
-            self.branch = branch
-            self.name = branch.name
-            self.commit = GitRepository.GitCommit(branch.commit)
+        def __init__(self, repo, name, id):
+            self.repo = repo
+            self.name = name
+            self.id = id
+            self._commit = None
+
+        @property
+        def commit(self):
+            # only load the commit if it's really needed
+            if self._commit is None:
+                self._commit = GitRepository.GitCommit(self.repo.commit(self.id))
+            return self._commit
 
     class GitTree:
         """emulating Repository.Tree fields"""
-        def __init__(self, tree):
+        def __init__(self, tree, batch=None):
             # emulate id field (has been renamed)
             self.id = tree.hexsha
 
@@ -75,24 +94,32 @@ class GitRepository(Repository):
             self._values = None
             self.is_tree = True
             self.tree = tree
+            self.batch = batch
 
         @property
         def values(self):
             if self._values is None:
-                trees = [GitRepository.GitTree(tree) for tree in self.tree.trees]
-                blobs = [GitRepository.GitBlob(blob) for blob in self.tree.blobs]
+                trees = [GitRepository.GitTree(tree, self.batch) for tree in self.tree.trees]
+                blobs = self.tree.blobs
+
+                # ask for the sizes of all blobs at once
+                sizes = [None] * len(blobs)
+                if self.batch is not None:
+                    sizes = [info and info[2] for info in self.batch.info(blob.hexsha for blob in blobs)]
+
+                blobs = [GitRepository.GitBlob(blob, size, self.batch) for blob, size in zip(blobs, sizes)]
                 self._values = trees + blobs
             return self._values
 
     class GitBlob:
         """emulating Repository.Blob fields"""
-        def __init__(self, blob):
+        def __init__(self, blob, size=None, batch=None):
             # emulate id field (has been renamed)
             self.id = blob.hexsha
 
             # one-to-one copy of fields
             self.name = blob.name
-            self.size = blob.size
+            self.size = blob.size if size is None else size
             self.mode = blob.mode
             self.mime_type = blob.mime_type
 
@@ -100,14 +127,109 @@ class GitRepository(Repository):
             self._data = None
             self.is_tree = False
             self.blob = blob
+            self.batch = batch
 
         @property
         def data(self):
             # only load data once
             if self._data is None:
-                self._data = self.blob.data_stream.read()
+                if self.batch is not None:
+                    self._data = self.batch.read([self.id])[0][2]
+                else:
+                    self._data = self.blob.data_stream.read()
             return self._data
 
+        def stream(self, start=0, stop=None, chunk_size=65536):
+            if stop is None or stop > self.size:
+                stop = self.size
+
+            # the data is already loaded, no need to ask git again
+            if self._data is not None:
+                for offset in xrange(start, stop, chunk_size):
+                    yield self._data[offset:min(offset + chunk_size, stop)]
+                return
+
+            stream = self.blob.data_stream
+            position = 0
+            while position < stop:
+                chunk = stream.read(min(chunk_size, stop - position))
+                if not chunk:
+                    break
+
+                # skip everything before the start of the range
+                if position + len(chunk) > start:
+                    yield chunk[max(start - position, 0):]
+                position += len(chunk)
+
+        def _line_offsets(self):
+            """
+                return an array with the offsets of the first byte of every
+                line, followed by the size of the blob. the offsets are
+                computed once per blob id, by streaming the blob.
+            """
+            offsets = _line_offsets.get(self.id)
+            if offsets is None:
+                import array
+                offsets = array.array('L', [0])
+                position = 0
+                for chunk in self.stream():
+                    start = 0
+                    while True:
+                        start = chunk.find("\n", start) + 1
+                        if start == 0:
+                            break
+                        offsets.append(position + start)
+                    position += len(chunk)
+
+                # a last line without newline
+                if offsets[-1] != position:
+                    offsets.append(position)
+                _line_offsets.set(self.id, offsets)
+            return offsets
+
+        @property
+        def line_count(self):
+            return len(self._line_offsets()) - 1
+
+        def lines(self, start=0, stop=None):
+            offsets = self._line_offsets()
+            count = len(offsets) - 1
+            if stop is None or stop > count:
+                stop = count
+            if start >= stop:
+                return []
+
+            data = "".join(self.stream(offsets[start], offsets[stop]))
+            if data.endswith("\n"):
+                data = data[:-1]
+            return data.split("\n")
+
+    class GitLastCommit:
+        """emulating the Repository.Commit fields used in listings"""
+        def __init__(self, entry):
+            self.id, self.committed_date, author, self.summary = entry
+            self.author = Actor(author, None)
+            self.message = self.summary
+
+    class GitChange:
+        """emulating Repository.Diff fields, the patch is loaded separately"""
+        def __init__(self, status, a_path, b_path, insertions, deletions):
+            self.status = status
+            self.a_path = a_path
+            self.b_path = b_path if b_path is not None else a_path
+
+            self.new_file = b_path if status == 'A' else None
+            self.deleted_file = a_path if status == 'D' else None
+            self.rename_from = a_path if status == 'R' else None
+            self.rename_to = b_path if status == 'R' else None
+
+            # numstat has no numbers for binary files
+            self.binary = insertions is None
+            self.stats = dict(insertions=insertions or 0, deletions=deletions or 0)
+
+            # the patch (without the header), None if not loaded
+            self.diff = None
+
     class GitCommit:
         """emulating Repository.Commit fields"""
         def __init__(self, commit):
@@ -118,6 +240,7 @@ class GitRepository(Repository):
             self._is_branch = None
             self._is_tag = None
             self._stats = None
+            self._changes = None
             self._tree = None
 
             # some computed stuff
@@ -142,21 +265,149 @@ class GitRepository(Repository):
         @property
         def is_branch(self):
             if self._is_branch is None:
-                self._is_branch = self.commit.hexsha in (head.commit.hexsha for head in self.commit.repo.branches)
+                self._is_branch = self.id in refs.decorated(self.repo.git_dir, functools.partial(_peel, self.repo))[0]
             return self._is_branch
 
         @property
         def is_tag(self):
             if self._is_tag is None:
-                self._is_tag = self.commit.hexsha in (tag.commit.hexsha for tag in self.commit.repo.tags)
+                self._is_tag = self.id in refs.decorated(self.repo.git_dir, functools.partial(_peel, self.repo))[1]
             return self._is_tag
 
+        def _diff_tree_args(self):
+            return ['-M', self.commit.parents[0].hexsha, self.id]
+
+        @property
+        def changes(self):
+            """
+                the list of GitChange objects of all files changed by this
+                commit (compared to its first parent), found together with
+                their numbers of changed lines by a single 'git diff-tree'.
+                the initial commit has no changes.
+            """
+            if self._changes is None and len(self.commit.parents) == 0:
+                self._changes = []
+            elif self._changes is None:
+                output = self.repo.git.diff_tree(*(['-r', '-z', '--raw', '--numstat', '--no-commit-id'] + self._diff_tree_args()))
+                fields = output.split('\0')
+
+                raw = []
+                numbers = []
+                n = 0
+                while n < len(fields):
+                    field = fields[n]
+                    if field.startswith(':'):
+                        # ':<mode> <mode> <id> <id> <status>' and the path(s)
+                        status = field.split()[4][0]
+                        if status in 'RC':
+                            raw.append((status, fields[n + 1], fields[n + 2]))
+                            n += 3
+                        else:
+                            raw.append((status, fields[n + 1], None))
+                            n += 2
+                    elif field:
+                        # '<insertions>\t<deletions>\t<path>', the path is
+                        # empty for renames and the two paths follow
+                        insertions, deletions, path = field.split('\t', 2)
+                        numbers.append((
+                            int(insertions) if insertions != '-' else None,
+                            int(deletions) if deletions != '-' else None
+                        ))
+                        n += 1 if path else 3
+                    else:
+                        n += 1
+
+                # both listings have the same order
+                numbers += [(None, None)] * (len(raw) - len(numbers))
+                self._changes = [
+                    GitRepository.GitChange(status, force_unicode(a_path), b_path and force_unicode(b_path), insertions, deletions)
+                    for (status, a_path, b_path), (insertions, deletions) in zip(raw, numbers)
+                ]
+            return self._changes
+
         @property
         def stats(self):
             if self._stats is None:
-                self._stats = self.commit.stats
+                stats = Repository.Stats()
+                stats.files = {}
+                stats.total = dict(files=0, insertions=0, deletions=0, lines=0)
+                for change in self.changes:
+                    stats.files[change.b_path] = dict(change.stats, lines=change.stats['insertions'] + change.stats['deletions'])
+                    stats.total['files'] += 1
+                    stats.total['insertions'] += change.stats['insertions']
+                    stats.total['deletions'] += change.stats['deletions']
+                stats.total['lines'] = stats.total['insertions'] + stats.total['deletions']
+                self._stats = stats
             return self._stats
 
+        @staticmethod
+        def _split_patches(lines, max_lines=None):
+            """
+                iterate over the patches of the files in the output of
+                'git diff-tree -p', without their headers. stop before the
+                patch that would exceed <max_lines> lines in total.
+            """
+            patch = None
+            total = 0
+            for line in lines:
+                if line.startswith('diff --git '):
+                    if patch is not None:
+                        total += len(patch)
+                        yield "".join(patch)
+                    patch = []
+                    header = True
+                elif patch is not None:
+                    if header and (line.startswith('@@') or line.startswith('Binary files')):
+                        header = False
+                    if not header:
+                        patch.append(line)
+                        if max_lines is not None and total + len(patch) > max_lines:
+                            return
+            if patch is not None:
+                yield "".join(patch)
+
+        def load_patches(self, max_files=None, max_lines=None):
+            """
+                load the patches (GitChange.diff) of the first changes, until
+                <max_files> patches or <max_lines> lines of patches were
+                loaded. git is stopped as soon as the limits are reached.
+                return the number of changes whose patches were loaded.
+            """
+            changes = self.changes
+            if max_files is not None:
+                changes = changes[:max_files]
+            if not changes:
+                return 0
+
+            process = self.repo.git.diff_tree(*(['-r', '-p', '--no-commit-id', '--no-color'] + self._diff_tree_args()), as_process=True)
+            loaded = 0
+            try:
+                for change, patch in zip(changes, self._split_patches(process.stdout, max_lines)):
+                    change.diff = patch.rstrip('\n')
+                    loaded += 1
+            finally:
+                _close_process(process, "patches of '%s'" % self.id)
+            return loaded
+
+        def patch(self, path):
+            """
+                return the GitChange of the file <path> with its patch
+                loaded, or None if the commit didn't change it
+            """
+            for change in self.changes:
+                if path in (change.a_path, change.b_path):
+                    break
+            else:
+                return None
+
+            paths = [change.a_path]
+            if change.b_path != change.a_path:
+                paths.append(change.b_path)
+            output = self.repo.git.diff_tree(*(['-r', '-p', '--no-commit-id', '--no-color'] + self._diff_tree_args() + ['--'] + paths))
+            patches = list(self._split_patches(line + '\n' for line in output.split('\n')))
+            change.diff = patches[0].rstrip('\n') if patches else ''
+            return change
+
         @property
         def tree(self):
             return self.commit.tree
@@ -167,9 +418,9 @@ class GitRepository(Repository):
 
         @property
         def diffs(self):
-            if len(self.commit.parents) > 0:
-                return self.commit.parents[0].diff(self.commit.hexsha, create_patch=True)
-            return []
+            changes = self.changes
+            self.load_patches()
+            return changes
 
     def __init__(self, **options):
         self.options = options
@@ -187,31 +438,106 @@ class GitRepository(Repository):
         self.description = self.repo.description
         self.name = self.options['repository'].rsplit("/", 1)[-1]
 
+        # handles are thrown away when references change, so the
+        # number of heads can be determined once
+        self._is_empty = len(self.repo.heads) == 0
+
+        # listings of branches and tags (see branches and tags)
+        self._branches = None
+        self._tags = None
+
+        # optionally read objects through persistent cat-file processes,
+        # which answer requests for many objects in one round trip
+        self.batch = None
+        if config.has_option('pool', 'batch') and config.getboolean('pool', 'batch'):
+            self.batch = CatFile(self.repo.git_dir)
+
         # if we have an empty repository we shall raise an error
         # so that we get redirected to a special page (except if
         # we force the loading of the repository)
-        if len(self.repo.heads) == 0 and (not 'force' in self.options.keys() or not self.options['force']):
+        if self._is_empty and (not 'force' in self.options.keys() or not self.options['force']):
             raise EmptyRepositoryError(self.name)
 
+    @staticmethod
+    def open(path, force=False):
+        """
+            return an already opened repository handle for <path> out of
+            the pool of this process, or open a new one. raises an
+            EmptyRepositoryError for empty repositories, unless <force>
+            is set.
+        """
+        repository = _pool.get(path)
+        if not force and repository.is_empty:
+            raise EmptyRepositoryError(repository.name)
+        return repository
+
+    def close(self):
+        # terminate the persistent git processes of this handle
+        self.repo.git.clear_cache()
+        if self.batch is not None:
+            self.batch.close()
+
     @property
     def is_bare(self):
         return self.repo.bare
 
     @property
     def is_empty(self):
-        return len(self.repo.heads) == 0
+        return self._is_empty
 
     @property
     def active_branch(self):
         return self.repo.active_branch.name
 
+    def _refs_listing(self):
+        return refs.listing(self.repo.git_dir, functools.partial(_peel, self.repo))
+
+    def _committed_dates(self, ids):
+        """
+            return a dictionary with the commit dates of the commits <ids>
+        """
+        missing = [id for id in ids if not id in _committed_dates]
+        if self.batch is not None:
+            commits = self._commits(missing)
+        else:
+            commits = (self.repo.commit(id) for id in missing)
+        for commit in commits:
+            _committed_dates.set(commit.hexsha, commit.committed_date)
+
+        return dict((id, _committed_dates.get(id, 0)) for id in ids)
+
+    def committed_date(self, id):
+        """
+            return the commit date of the commit <id> (as seconds since
+            the epoch). the dates are remembered per id.
+        """
+        return self._committed_dates([id])[id]
+
     @property
     def branches(self):
-        return sorted((GitRepository.GitBranch(b) for b in self.repo.heads), key=lambda x: x.commit.committed_date, reverse=True)
+        branches = self._refs_listing()[0]
+        if self._branches is None or self._branches[0] is not branches:
+            # the order of the branches is shared by all handles
+            # of the same repository
+            order = _branch_order.get(self.repo.git_dir)
+            if order is None or order[0] is not branches:
+                dates = self._committed_dates(set(branches.values()))
+                order = (branches, sorted(branches, key=lambda name: dates[branches[name]], reverse=True))
+                _branch_order.set(self.repo.git_dir, order)
+
+            self._branches = (branches, [GitRepository.GitBranch(self.repo, name, branches[name]) for name in order[1]])
+        return self._branches[1]
 
     @property
     def tags(self):
-        return [GitRepository.GitBranch(b) for b in self.repo.tags]
+        tags = self._refs_listing()[1]
+        if self._tags is None or self._tags[0] is not tags:
+            self._tags = (tags, [GitRepository.GitBranch(self.repo, name, tags[name]) for name in sorted(tags)])
+        return self._tags[1]
+
+    @property
+    def decorations(self):
+        return refs.decorations(self.repo.git_dir, functools.partial(_peel, self.repo))
 
     @property
     def clone_urls(self):
@@ -253,10 +579,9 @@ class GitRepository(Repository):
             file = self.active_branch + "/README"
             blob = self.blob(file)
 
-            from pyggi.lib.filters import html_escape_table
+            from pyggi.lib.filters import escape_html
 
-            data = unicode(blob.data, 'utf-8')
-            data = "".join(html_escape_table.eet(c, c) if c != "\n" else "<br/>" for c in data)
+            data = escape_html(force_unicode(blob.data)).replace("\n", "<br/>")
 
             return Repository.Readme(\
                 name="README",
@@ -285,6 +610,33 @@ class GitRepository(Repository):
 
         return True
 
+    @staticmethod
+    def summarize(path):
+        try:
+            repo = Repo(path)
+        except:
+            return None
+
+        try:
+            summary = dict(
+                description=repo.description,
+                daemon_export=repo.daemon_export,
+                head=None,
+                last_date=None,
+                last_author=None
+            )
+
+            if len(repo.heads) > 0:
+                commit = repo.head.commit
+                summary['head'] = commit.hexsha
+                summary['last_date'] = commit.committed_date
+                summary['last_author'] = commit.author.name
+            return summary
+        except:
+            return None
+        finally:
+            repo.git.clear_cache()
+
     @staticmethod
     def resolve_ref(repository, ref):
         if not os.path.exists(repository):
@@ -296,38 +648,246 @@ class GitRepository(Repository):
         if sha_regex.match(ref) is not None:
             return ref
 
+        # most references can be resolved by reading the reference
+        # files, without opening the repository
+        sha = refs.resolve(git_dir(repository), ref)
+        if sha is not None:
+            return sha
+
         try:
-            return GitRepository(repository).commit(ref).hexsha
+            return GitRepository.open(repository, force=True).commit(ref).id
         except:
             return None
 
-    def _traverse_tree(self, path):
+    def _lookup(self, path):
+        """
+            return the object at <path>, where the first component of <path>
+            is a treeish. the trees are descended one level per component of
+            the path, and the result is remembered per (tree, path).
+        """
         rev, path = (path + "/").split("/", 1)
+        path = path[:-1]
         tree = self.repo.tree(rev)
         if path == "":
-            return (x for x in [tree])
-        return tree.traverse(predicate=lambda i, d: i.path == path[:-1])
+            return tree
+
+        key = (tree.binsha, path)
+        entry = _lookups.get(key)
+        if entry is None:
+            item = tree
+            for name in path.split("/"):
+                if item.type != 'tree':
+                    raise KeyError(path)
+                item = item / name
+            entry = (item.binsha, item.mode, item.type)
+            _lookups.set(key, entry)
+
+        binsha, mode, type = entry
+        if type == 'tree':
+            return Tree(self.repo, binsha, mode, path)
+        if type == 'blob':
+            return Blob(self.repo, binsha, mode, path)
+        raise KeyError(path)
 
     def blob(self, path):
         try:
-            gen = self._traverse_tree(path)
-            return GitRepository.GitBlob(gen.next())
+            return GitRepository.GitBlob(self._lookup(path), batch=self.batch)
         except BadObject:
             raise RepositoryError("Repository '%s' has no tree '%s'" % (self.path, path))
-        except StopIteration:
+        except KeyError:
             raise RepositoryError("Repository '%s' has no tree '%s'" % (self.path, path))
 
     def tree(self, path):
         try:
-            gen = self._traverse_tree(path)
-            return GitRepository.GitTree(gen.next())
+            return GitRepository.GitTree(self._lookup(path), self.batch)
         except BadObject:
             raise RepositoryError("Repository '%s' has no tree '%s'" % (self.path, path))
-        except StopIteration:
+        except KeyError:
             raise RepositoryError("Repository '%s' has no tree '%s'" % (self.path, path))
 
-    def last_activities(self, treeish, count=4, skip=0):
-        return (GitRepository.GitCommit(c) for c in self.repo.iter_commits(treeish, max_count=count, skip=skip))
+    def _commits(self, ids):
+        """
+            read the commits <ids> through the cat-file processes
+            in one round trip
+        """
+        import binascii
+        from cStringIO import StringIO
+        from git.objects import Commit
+
+        result = []
+        for entry in self.batch.read(ids):
+            if entry is None or entry[1] != 'commit':
+                continue
+            commit = Commit(self.repo, binascii.a2b_hex(entry[0]))
+            commit._deserialize(StringIO(entry[2]))
+            result.append(commit)
+        return result
+
+    def _write_commit_graph(self, missing=False, background=False):
+        """
+            let git write the commit-graph file of the repository (if enabled),
+            including the Bloom filters of the changed paths of every commit.
+            if <missing> is given, it's only written if there is none with
+            Bloom filters yet (git gc writes it without them).
+
+            if <background> is given, the file is written by a thread of its
+            own. this is only tried once per repository and process, so a
+            write that fails doesn't slow down every request.
+        """
+        if not (config.has_option('index', 'commit_graph') and config.getboolean('index', 'commit_graph')):
+            return
+
+        if missing and _has_changed_paths(os.path.join(git_dir(self.path), 'objects', 'info')):
+            return
+
+        if not background:
+            _commit_graph_write(self.repo.git, self.path)
+            return
+
+        with _commit_graph_lock:
+            if self.path in _commit_graph_started:
+                return
+            _commit_graph_started.add(self.path)
+
+        # the handle belongs to the thread of the request
+        thread = threading.Thread(target=_commit_graph_write, args=(Repo(self.path).git, self.path),
+            name="pyggi-commit-graph")
+        thread.daemon = True
+        thread.start()
+
+    def _commit_list(self, start):
+        """
+            return the CommitList of all commits reachable from <start>
+        """
+        id = self.commit(start).id
+
+        def build(known):
+            # if one of the last lists is an ancestor, only the
+            # commits since then have to be listed
+            base = None
+            for candidate in known[:4]:
+                try:
+                    if self.repo.git.merge_base(candidate, id) == candidate:
+                        base = candidate
+                        break
+                except GitCommandError:
+                    pass
+
+            if base is None:
+                # a full walk of the history: let git build its
+                # commit-graph first to speed this up
+                self._write_commit_graph()
+                process = self.repo.git.rev_list(id, as_process=True)
+            else:
+                process = self.repo.git.rev_list(id, '^' + base, as_process=True)
+
+            def binshas():
+                try:
+                    for line in process.stdout:
+                        yield binascii.a2b_hex(line.strip())
+                finally:
+                    _close_process(process, "commit list of '%s' in '%s'" % (id, self.path))
+
+            return (base, binshas())
+
+        return get_commit_list_index().get(self.path, id, build)
+
+    def last_activities(self, treeish, count=4, skip=0, after=None, paged=False):
+        if paged or after is not None or skip > 0:
+            # pages further down the history are sliced out of
+            # the commit list, instead of letting git skip them.
+            # the list is not in the order of git (it's appended
+            # to older lists), so pages must all come from it
+            commits = self._commit_list(treeish)
+            if after is not None:
+                skip = commits.position(after) + 1
+            ids = commits.slice(skip, count)
+        elif self.batch is not None:
+            ids = self.repo.git.rev_list(treeish, max_count=count).split()
+        else:
+            return (GitRepository.GitCommit(c) for c in self.repo.iter_commits(treeish, max_count=count))
+
+        if self.batch is not None:
+            return (GitRepository.GitCommit(c) for c in self._commits(ids))
+        return (GitRepository.GitCommit(self.repo.commit(id)) for id in ids)
+
+    def _log(self, rev, path):
+        """
+            iterate over tuples (id, committed_date, author, summary, paths,
+            parents) of the commits reachable from <rev> that changed something
+            below <path>, newest first. paths is the list of changed files,
+            parents the list of the parents among these commits.
+        """
+        args = [rev]
+        if path:
+            args += ['--', path]
+        process = self.repo.git.log(*args, z=True, name_only=True, parents=True,
+            format='%x01%H %ct %an%x00%s%x00%P', as_process=True)
+
+        def parse(record):
+            fields = record.split('\0') + ['', '']
+            header = fields[0].split(' ', 2) + ['']
+            summary = force_unicode(fields[1])
+            parents = fields[2].split()
+            paths = [force_unicode(name.lstrip('\n')) for name in fields[3:] if name.strip('\n')]
+            return (header[0], int(header[1]), force_unicode(header[2]), summary, paths, parents)
+
+        try:
+            pending = ''
+            while True:
+                chunk = process.stdout.read(65536)
+                records = (pending + chunk).split('\x01')
+                pending = records.pop()
+                for record in records:
+                    if record:
+                        yield parse(record)
+                if not chunk:
+                    if pending:
+                        yield parse(pending)
+                    break
+        finally:
+            _close_process(process, "log of '%s' in '%s'" % (rev, self.path))
+
+    def last_commits(self, treeish, path=""):
+        path = path.strip("/")
+        commit = self.commit(treeish).id
+
+        index = get_last_commit_index()
+        entries = index.get(self.path, commit, path)
+        if entries is None:
+            tree = self.tree("/".join(x for x in [commit, path] if x))
+            names = set(force_unicode(item.name) for item in tree.values)
+            known = index.commits(self.path, path)
+            prefix = path + "/" if path else ""
+
+            entries = {}
+            merged = False
+            for id, date, author, summary, paths, parents in self._log(commit, path):
+                if id in known and id != commit and not merged:
+                    # the rest is known from an earlier walk. after a merge,
+                    # commits of the merged branches might still follow
+                    for name, entry in index.get(self.path, id, path).items():
+                        if name in names:
+                            entries[name] = entry
+                    break
+
+                for filename in paths:
+                    name = filename[len(prefix):].split("/", 1)[0]
+                    if name in names:
+                        entries[name] = [id, date, author, summary]
+                        names.discard(name)
+
+                if not names:
+                    break
+                merged = merged or len(parents) > 1
+
+            index.set(self.path, commit, path, entries)
+
+        return dict((name, GitRepository.GitLastCommit(entry)) for name, entry in entries.items())
+
+    def last_commit(self, tree, path):
+        directory, _, name = path.strip("/").rpartition("/")
+        return self.last_commits(tree, directory).get(force_unicode(name))
 
     def commit(self, rev):
         try:
@@ -362,36 +922,387 @@ class GitRepository(Repository):
 
         return []
 
-    def history(self, path):
-        breadcrumbs = path.split("/")
-        return (
-            GitRepository.GitCommit(c) for c in
-                self.repo.iter_commits(breadcrumbs[0], "/".join(breadcrumbs[1:]))
-        )
+    def history(self, path, count=None, after=None):
+        rev, path = (path + "/").split("/", 1)
+        path = path[:-1]
+
+        # the walk skips commits that can't have touched the
+        # path with the Bloom filters of the commit-graph
+        self._write_commit_graph(missing=True, background=True)
+
+        options = dict()
+        if count is not None:
+            options['max_count'] = count
+
+        if after is not None:
+            # continue the walk of an earlier page, which ended with the
+            # commit <after>. the walk has to start at <rev> again, commits
+            # of merged branches are not reachable from <after>
+            ids = self._history_after(rev, path, count, after)
+        elif self.batch is None:
+            return (GitRepository.GitCommit(c) for c in self.repo.iter_commits(rev, path, **options))
+        else:
+            ids = self.repo.git.rev_list(rev, '--', path, **options).split()
+
+        if self.batch is not None:
+            return (GitRepository.GitCommit(c) for c in self._commits(ids))
+        return (GitRepository.GitCommit(self.repo.commit(id)) for id in ids)
+
+    def _history_after(self, rev, path, count, after):
+        """
+            return the ids of up to <count> commits of the history of <path>
+            at <rev> that follow the commit <after>
+        """
+        ids = []
+        found = False
+        process = self.repo.git.rev_list(rev, '--', path, as_process=True)
+        try:
+            for line in process.stdout:
+                id = line.strip()
+                if not found:
+                    found = id == after
+                    continue
+                ids.append(id)
+                if count is not None and len(ids) >= count:
+                    break
+        finally:
+            _close_process(process, "history of '%s' in '%s'" % (path, self.path))
+        return ids
+
+    # number of commits of the history of a file that are searched
+    # for a known blame, before the file is blamed from scratch
+    blame_depth = 100
+
+    def _blame(self, commit, path):
+        """
+            iterate over tuples (id, line, count) in the order 'git blame
+            --incremental' finds them: the <count> lines starting at <line>
+            (0-based) of <path> at <commit> come from the commit <id>.
+        """
+        process = self.repo.git.blame('--incremental', commit, '--', path, as_process=True)
 
-    def blame(self, path):
-        breadcrumbs = path.split("/")
-        return ((GitRepository.GitCommit(c), b) for c, b in
-            self.repo.blame(breadcrumbs[0], "/".join(breadcrumbs[1:]))
-        )
+        try:
+            header = True
+            for line in process.stdout:
+                if header:
+                    fields = line.split()
+                    yield (fields[0], int(fields[2]) - 1, int(fields[3]))
+                    header = False
+                elif line.startswith('filename '):
+                    # the last line of the information about a group
+                    header = True
+        except:
+            _close_process(process)
+            raise
 
-    def commit_count(self, start):
+        # everything was read, so git has finished. a blame that failed
+        # must not be taken (and stored) as a blame without lines
         try:
-            commit = self.repo.commit(start)
-            return commit.count()
-        except BadObject:
-            raise RepositoryError("Repository '%s' has no branch '%s'" % (self.path, start))
+            process.wait()
+        except GitCommandError as e:
+            raise RepositoryError("Repository '%s' could not blame '%s' in '%s': %s" % (self.path, path, commit, e))
+        finally:
+            process.stdout.close()
+
+    def _changed_lines(self, base, commit, path):
+        """
+            return a list of (old start, old count, new start, new count)
+            tuples of the lines of <path> that changed between <base> and
+            <commit>. the starts are 0-based.
+        """
+        import re
+        hunk = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+        result = []
+        for line in self.repo.git.diff(base, commit, '--', path, unified=0, no_color=True, no_ext_diff=True).split('\n'):
+            match = hunk.match(line)
+            if match is None:
+                continue
+            a, b, c, d = [int(x) if x is not None else 1 for x in match.groups()]
+            # empty ranges name the line before them
+            result.append((a - 1 if b else a, b, c - 1 if d else c, d))
+        return result
+
+    def _blame_runs(self, treeish, path):
+        """
+            iterate over tuples (id, line, count) of the blame of <path> at
+            <treeish> (see _blame). the blame is stored in the blame index,
+            keyed by the last commit that changed the file.
+
+            if the blame of an earlier version of the file is known, and
+            every version since then has a single parent, the blame is
+            carried forward version by version: the lines a version changed
+            come from that version, the others keep their blame. merges
+            have to be blamed by git.
+        """
+        parents = {}
+        history = []
+        for line in self.repo.git.rev_list(self.commit(treeish).id, '--', path, parents=True, max_count=self.blame_depth).split('\n'):
+            if line:
+                ids = line.split()
+                history.append(ids[0])
+                parents[ids[0]] = ids[1:]
+        if not history:
+            raise RepositoryError("Repository '%s' has no file '%s' in '%s'" % (self.path, path, treeish))
+        commit = history[0]
+
+        index = get_blame_index()
+        runs = index.get(self.path, commit, path)
+        if runs is not None:
+            line = 0
+            for id, count in runs:
+                yield (id, line, count)
+                line += count
+            return
+
+        # the versions since the nearest known blame, newest first
+        known = index.commits(self.path, path)
+        versions = [commit]
+        base = None
+        while base is None:
+            ids = parents.get(versions[-1])
+            if ids is None or len(ids) != 1:
+                # a merge, the first version or too far away
+                versions = None
+                break
+            if ids[0] in known:
+                base = ids[0]
+            else:
+                versions.append(ids[0])
+
+        # the blame of every line
+        lines = []
+        if versions is not None:
+            for id, count in index.get(self.path, base, path):
+                lines.extend([id] * count)
+
+            for version in reversed(versions):
+                old, lines, position = lines, [], 0
+                for old_start, old_count, new_start, new_count in self._changed_lines(base, version, path):
+                    lines.extend(old[position:old_start])
+                    lines.extend([version] * new_count)
+                    position = old_start + old_count
+                lines.extend(old[position:])
+                base = version
+
+            start = 0
+            for n in xrange(1, len(lines) + 1):
+                if n == len(lines) or lines[n] != lines[start]:
+                    yield (lines[start], start, n - start)
+                    start = n
+        else:
+            for id, line, count in self._blame(commit, path):
+                if line + count > len(lines):
+                    lines.extend([None] * (line + count - len(lines)))
+                lines[line:line + count] = [id] * count
+                yield (id, line, count)
+
+        # only complete blames are stored, _blame raises if git failed
+        runs = []
+        for id in lines:
+            if runs and runs[-1][0] == id:
+                runs[-1][1] += 1
+            else:
+                runs.append([id, 1])
+        index.set(self.path, commit, path, runs)
+
+    def _blame_commits(self):
+        """
+            return a function that returns the GitCommit of an id, loading
+            every commit only once
+        """
+        commits = {None: None}
+        def load(id):
+            if id not in commits:
+                commits[id] = GitRepository.GitCommit(self.repo.commit(id))
+            return commits[id]
+        return load
+
+    def blame(self, path):
+        rev, path = (path + "/").split("/", 1)
+        path = path[:-1]
+
+        data = self.blob("/".join([rev, path])).data.split("\n")
+        if data[-1] == "":
+            # the last line ends with a newline
+            data.pop()
+        commit = self._blame_commits()
+
+        # git finds the origins of the lines in any order. the groups of
+        # lines are passed on as soon as all lines above them are known,
+        # so the page can be rendered while the blame is computed
+        lines = [None] * len(data)
+        start = known = 0
+        for id, line, count in self._blame_runs(rev, path):
+            if line + count > len(lines):
+                lines.extend([None] * (line + count - len(lines)))
+            lines[line:line + count] = [id] * count
+
+            while known < len(lines) and lines[known] is not None:
+                known += 1
+
+            # the last group above the first unknown line might go on
+            for n in xrange(start + 1, known + 1):
+                if n == len(lines) or (n < known and lines[n] != lines[start]):
+                    yield (commit(lines[start]), data[start:n])
+                    start = n
+
+        # lines git did not name
+        for n in xrange(start + 1, len(lines) + 1):
+            if n == len(lines) or lines[n] != lines[start]:
+                yield (commit(lines[start]), data[start:n])
+                start = n
+
+    def blame_incremental(self, path):
+        rev, path = (path + "/").split("/", 1)
+        path = path[:-1]
 
-    def archive(self, treeish):
-       try:
-            from tempfile import TemporaryFile
-            with TemporaryFile(mode='w+b') as fp:
-                self.repo.archive(fp, treeish)
-                fp.flush()
-                fp.seek(0)
-                data = fp.read()
+        commit = self._blame_commits()
+        for id, line, count in self._blame_runs(rev, path):
+            yield (commit(id), line, count)
 
-            return data
-       except GitCommandError:
-            raise RepositoryError("Repository '%s' has no tree '%s'" % (self.path, treeish))
+    def commit_count(self, start):
+        return len(self._commit_list(start))
+
+    def commit_position(self, start, id):
+        """
+            return the position of commit <id> in the history of <start>,
+            or -1 if it's not part of it
+        """
+        return self._commit_list(start).position(id)
+
+    # archive formats: name -> (format for git-archive, gzip compressed)
+    archive_formats = {
+        'tar': ('tar', False),
+        'tar.gz': ('tar', True),
+        'tgz': ('tar', True),
+        'zip': ('zip', False),
+    }
+
+    def archive(self, treeish, format='tar', chunk_size=65536):
+        if not format in GitRepository.archive_formats:
+            raise RepositoryError("Unknown archive format '%s'" % format)
+        git_format, compress = GitRepository.archive_formats[format]
+
+        # make sure the tree exists, before a response is started
+        self.commit(treeish)
+
+        def generate():
+            # git is only started once the response is sent, a response
+            # that is closed before that never runs the generator
+            process = self.repo.git.archive(treeish, format=git_format, as_process=True)
+            try:
+                compressor = None
+                if compress:
+                    import zlib
+                    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+                while True:
+                    chunk = process.stdout.read(chunk_size)
+                    if not chunk:
+                        break
+                    if compressor is not None:
+                        chunk = compressor.compress(chunk)
+                        if not chunk:
+                            continue
+                    yield chunk
+
+                if compressor is not None:
+                    yield compressor.flush()
+            finally:
+                # the client might have gone away in the middle of
+                # the download, don't leave the process behind
+                _close_process(process, "archive of '%s' in '%s'" % (treeish, self.path))
+
+        return generate()
+
+def _peel(repo, id):
+    try:
+        return repo.commit(id).hexsha
+    except:
+        return None
 
+def _has_changed_paths(info):
+    """
+        return True if the commit-graph in the directory <info> holds the
+        Bloom filters of the changed paths
+    """
+    import struct
+
+    path = os.path.join(info, 'commit-graph')
+    chain = os.path.join(info, 'commit-graphs', 'commit-graph-chain')
+    if os.path.exists(chain):
+        # a split commit-graph, the newest layer is listed last
+        try:
+            with open(chain, 'rb') as fp:
+                layers = fp.read().split()
+        except (IOError, OSError):
+            return False
+        if not layers:
+            return False
+        path = os.path.join(info, 'commit-graphs', 'graph-%s.graph' % layers[-1].decode('ascii'))
+
+    try:
+        with open(path, 'rb') as fp:
+            header = fp.read(8)
+            if len(header) < 8 or header[:4] != b'CGPH':
+                return False
+            chunks = struct.unpack('B', header[6:7])[0]
+            table = fp.read(12 * (chunks + 1))
+    except (IOError, OSError):
+        return False
+
+    return any(table[n:n+4] == b'BIDX' for n in xrange(0, len(table), 12))
+
+def _commit_graph_write(git, path):
+    # the options belong to the subcommand, GitPython would put
+    # keyword options in front of it
+    try:
+        git.commit_graph('write', '--reachable', '--changed-paths')
+    except GitCommandError:
+        # git before 2.27 doesn't know about changed paths
+        try:
+            git.commit_graph('write', '--reachable')
+        except GitCommandError as e:
+            logging.warning("could not write commit-graph of '%s': %s", path, e)
+
+def _close_process(process, description=None):
+    """
+        close a git process that was started with as_process=True. if it
+        is still running, it gets killed. otherwise a failure of the
+        process is logged using <description>.
+    """
+    killed = False
+    process.stdout.close()
+    if process.poll() is None:
+        process.kill()
+        killed = True
+
+    try:
+        process.wait()
+    except GitCommandError as e:
+        if not killed and description is not None:
+            logging.error("git failed to create %s: %s", description, e)
+
+# commit dates of the heads of branches and the order of the
+# branches by these dates, keyed by git directory
+_committed_dates = LRUCache(8192)
+_branch_order = LRUCache(256)
+
+# repositories whose commit-graph was written in the background
+_commit_graph_started = set()
+_commit_graph_lock = threading.Lock()
+
+# objects found at (tree, path): trees never change, so the
+# results can be shared by all repository handles
+_lookups = LRUCache(4096)
+
+_pool_size = 32
+if config.has_option('pool', 'size'):
+    _pool_size = config.getint('pool', 'size')
+_pool = RepositoryPool(lambda path: GitRepository(repository=path, force=True), _pool_size)
+
+# offsets of the lines of blobs, keyed by blob id: blobs never
+# change, so the offsets only have to be computed once. at most
+# 16 megabytes of offsets are kept
+_line_offsets = LRUCache(32, weight=lambda offsets: offsets.itemsize * len(offsets), max_weight=16 * 1024 * 1024)
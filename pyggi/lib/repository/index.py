@@ -0,0 +1,615 @@
+# -*- coding: utf-8 -*-
+
+"""
+    :copyright: (c) 2011 by Tobias Heinzen
+    :license: BSD, see LICENSE for more details
+"""
+
+import os, os.path
+import time
+import threading
+import sqlite3
+import json
+import mmap
+import binascii
+import hashlib
+import shutil
+import tempfile
+import logging
+from pyggi.lib.config import config
+from pyggi.lib.repository.pool import git_dir, repository_state
+
+class RepositoryIndex(object):
+    """
+        an on-disk index of all repositories in a repository base
+        directory, holding everything the repository listing shows.
+
+        the index is refreshed incrementally: only repositories whose
+        directory or references changed since the last refresh are
+        opened again. up to <threads> repositories are opened at the
+        same time, which hides the latency of slow (network) storage.
+        callers wait at most <wait> seconds for a refresh that is run by
+        another thread, and then scan the repositories themselves.
+    """
+
+    class Entry(object):
+        """emulating the fields of a repository in listings"""
+        def __init__(self, row):
+            self.name = row['name']
+            self.description = row['description']
+            self.daemon_export = bool(row['daemon_export'])
+            self.head = row['head']
+            self.last_date = row['last_date']
+            self.last_author = row['last_author']
+            self.is_empty = self.head is None
+
+    def __init__(self, filename, interval=30, threads=4, wait=60):
+        self.filename = filename
+        self.interval = interval
+        self.threads = threads
+        self.wait = wait
+        self._refreshed = {}
+        self._running = {}
+        self._done = set()
+        self._lock = threading.Lock()
+
+        connection = self._connect()
+        try:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS repositories (
+                    base TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    valid INTEGER NOT NULL,
+                    description TEXT,
+                    daemon_export INTEGER,
+                    head TEXT,
+                    last_date INTEGER,
+                    last_author TEXT,
+                    PRIMARY KEY (base, name)
+                )
+            """)
+            connection.commit()
+        finally:
+            connection.close()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.filename, timeout=30)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    @staticmethod
+    def _state(path):
+        # the description is edited in place, which leaves the
+        # directory modification times untouched
+        state = []
+        for name in [path, os.path.join(git_dir(path), 'description')]:
+            try:
+                state.append(os.stat(name).st_mtime)
+            except OSError:
+                state.append(None)
+        return repr(tuple(state) + repository_state(path))
+
+    def _map(self, function, items):
+        """
+            return [function(item) for item in items], computed by up
+            to <threads> threads in parallel
+        """
+        if self.threads <= 1 or len(items) <= 1:
+            return [function(item) for item in items]
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(self.threads, len(items)))
+        try:
+            return pool.map(function, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def refresh(self, base, force=False):
+        """
+            bring the index of the repositories in <base> up to date. unless
+            <force> is given, this happens at most once every <interval>
+            seconds per process.
+
+            only one refresh per base runs at a time. if the index of <base>
+            was not refreshed by this process yet, callers wait for a running
+            refresh (like the one started by warm_up) instead of reading an
+            incomplete index.
+        """
+        with self._lock:
+            running = self._running.get(base)
+            refreshed = base in self._done
+            if running is None:
+                now = time.time()
+                if not force and now - self._refreshed.get(base, 0) < self.interval:
+                    return
+                self._refreshed[base] = now
+                self._running[base] = threading.Event()
+
+        if running is not None:
+            if not refreshed and not running.wait(self.wait):
+                logging.warning("the scan of %s takes longer than %d seconds, scanning again", base, self.wait)
+                self._refresh(base)
+            return
+
+        try:
+            self._refresh(base)
+        finally:
+            with self._lock:
+                self._running.pop(base).set()
+                self._done.add(base)
+
+    def _refresh(self, base):
+        from pyggi.lib.repository.gitr import GitRepository
+
+        try:
+            names = [name for name in os.listdir(base) if os.path.isdir(os.path.join(base, name))]
+        except OSError:
+            logging.warning("repository base %s does not exist", base)
+            names = []
+
+        connection = self._connect()
+        try:
+            known = dict(
+                (row['name'], row['state']) for row in
+                    connection.execute("SELECT name, state FROM repositories WHERE base = ?", (base,))
+            )
+
+            def scan(name):
+                # the state is taken before the repository is read, so
+                # changes in between are noticed by the next refresh
+                path = os.path.join(base, name)
+                state = self._state(path)
+                if known.get(name) == state:
+                    return (state, False)
+                return (state, GitRepository.summarize(path))
+
+            for name, (state, summary) in zip(names, self._map(scan, names)):
+                known.pop(name, None)
+                if summary is False:
+                    # unchanged
+                    continue
+                self._store(connection, base, name, state, summary)
+
+            # everything that is left, is gone from the disk
+            for name in known:
+                connection.execute("DELETE FROM repositories WHERE base = ? AND name = ?", (base, name))
+
+            connection.commit()
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _store(connection, base, name, state, summary):
+        if summary is None:
+            connection.execute(
+                "INSERT OR REPLACE INTO repositories (base, name, state, valid) VALUES (?, ?, ?, 0)",
+                (base, name, state)
+            )
+        else:
+            connection.execute(
+                "INSERT OR REPLACE INTO repositories VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?)",
+                (base, name, state, summary['description'], summary['daemon_export'],
+                    summary['head'], summary['last_date'], summary['last_author'])
+            )
+
+    def update(self, base, name):
+        """
+            bring the entry of the repository <name> in <base> up to date,
+            without looking at the other repositories
+        """
+        from pyggi.lib.repository.gitr import GitRepository
+
+        path = os.path.join(base, name)
+        state = self._state(path)
+        summary = GitRepository.summarize(path)
+
+        connection = self._connect()
+        try:
+            self._store(connection, base, name, state, summary)
+            connection.commit()
+        finally:
+            connection.close()
+
+    def query(self, base, sort='name', prefix=None, offset=0, limit=None):
+        """
+            return a tuple (total, entries) where entries is a list of
+            RepositoryIndex.Entry objects for the repositories in <base>
+            and total is the number of repositories that matched.
+
+            @param sort     'name' to sort by name, or 'updated' to sort by
+                            the date of the last commit (newest first)
+            @param prefix   only list repositories whose name or description
+                            starts with <prefix>
+            @param offset   number of repositories to skip
+            @param limit    maximum number of entries to return
+        """
+        self.refresh(base)
+
+        try:
+            preserve_daemon_export = config.getboolean('general', 'preserve_daemon_export')
+        except:
+            preserve_daemon_export = True
+
+        where = " FROM repositories WHERE base = ? AND valid = 1"
+        arguments = [base]
+        if preserve_daemon_export:
+            where += " AND daemon_export = 1"
+        if prefix:
+            pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            where += " AND (name LIKE ? ESCAPE '\\' OR description LIKE ? ESCAPE '\\')"
+            arguments += [pattern, pattern]
+
+        if sort == 'updated':
+            order = " ORDER BY last_date IS NULL, last_date DESC, name"
+        else:
+            order = " ORDER BY name"
+
+        limits = ""
+        if limit is not None:
+            limits = " LIMIT %d OFFSET %d" % (limit, offset)
+        elif offset:
+            limits = " LIMIT -1 OFFSET %d" % offset
+
+        connection = self._connect()
+        try:
+            total = connection.execute("SELECT COUNT(*)" + where, arguments).fetchone()[0]
+            entries = [
+                RepositoryIndex.Entry(row) for row in
+                    connection.execute("SELECT *" + where + order + limits, arguments)
+            ]
+            return (total, entries)
+        finally:
+            connection.close()
+
+    def repositories(self, base):
+        """
+            return a list of RepositoryIndex.Entry objects for all
+            repositories in <base>, sorted by name
+        """
+        return self.query(base)[1]
+
+class LastCommitIndex(object):
+    """
+        an on-disk index of the last commit that touched each entry of a
+        directory, stored per (repository, commit, directory).
+
+        an entry maps the name of an item in the directory to a list
+        [id, committed_date, author name, summary] of the last commit
+        that changed it.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        connection = self._connect()
+        try:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS last_commits (
+                    repository TEXT NOT NULL,
+                    directory TEXT NOT NULL,
+                    commit_id TEXT NOT NULL,
+                    entries TEXT NOT NULL,
+                    PRIMARY KEY (repository, directory, commit_id)
+                )
+            """)
+            connection.commit()
+        finally:
+            connection.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.filename, timeout=30)
+
+    def get(self, repository, commit, directory):
+        """
+            return the entries of <directory> at <commit> or None
+        """
+        connection = self._connect()
+        try:
+            row = connection.execute(
+                "SELECT entries FROM last_commits WHERE repository = ? AND directory = ? AND commit_id = ?",
+                (repository, directory, commit)
+            ).fetchone()
+        finally:
+            connection.close()
+
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def commits(self, repository, directory):
+        """
+            return the set of commits for which the entries of
+            <directory> are known
+        """
+        connection = self._connect()
+        try:
+            return set(row[0] for row in connection.execute(
+                "SELECT commit_id FROM last_commits WHERE repository = ? AND directory = ?",
+                (repository, directory)
+            ))
+        finally:
+            connection.close()
+
+    def set(self, repository, commit, directory, entries):
+        connection = self._connect()
+        try:
+            connection.execute(
+                "INSERT OR REPLACE INTO last_commits VALUES (?, ?, ?, ?)",
+                (repository, directory, commit, json.dumps(entries))
+            )
+            connection.commit()
+        finally:
+            connection.close()
+
+class BlameIndex(object):
+    """
+        an on-disk index of the blame of files, stored per (repository,
+        commit, path) where commit is the last commit that changed the
+        file.
+
+        a blame is a list of [id, count] pairs: the next <count> lines of
+        the file come from the commit <id>.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        connection = self._connect()
+        try:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS blames (
+                    repository TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    commit_id TEXT NOT NULL,
+                    lines TEXT NOT NULL,
+                    PRIMARY KEY (repository, path, commit_id)
+                )
+            """)
+            connection.commit()
+        finally:
+            connection.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.filename, timeout=30)
+
+    def get(self, repository, commit, path):
+        """
+            return the blame of <path> at <commit> or None
+        """
+        connection = self._connect()
+        try:
+            row = connection.execute(
+                "SELECT lines FROM blames WHERE repository = ? AND path = ? AND commit_id = ?",
+                (repository, path, commit)
+            ).fetchone()
+        finally:
+            connection.close()
+
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def commits(self, repository, path):
+        """
+            return the set of commits for which the blame of <path> is known
+        """
+        connection = self._connect()
+        try:
+            return set(row[0] for row in connection.execute(
+                "SELECT commit_id FROM blames WHERE repository = ? AND path = ?",
+                (repository, path)
+            ))
+        finally:
+            connection.close()
+
+    def set(self, repository, commit, path, lines):
+        connection = self._connect()
+        try:
+            connection.execute(
+                "INSERT OR REPLACE INTO blames VALUES (?, ?, ?, ?)",
+                (repository, path, commit, json.dumps(lines))
+            )
+            connection.commit()
+        finally:
+            connection.close()
+
+class CommitList(object):
+    """
+        the ids of all commits reachable from a commit, in the order
+        'git rev-list' lists them. the list is memory mapped from its file,
+        so counting and slicing it doesn't depend on the length of the
+        history.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            self._data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self._data) // 20
+
+    def slice(self, offset, count):
+        """
+            return the ids of the commits [offset, offset+count)
+        """
+        data = self._data[offset*20:(offset + count)*20]
+        return [binascii.b2a_hex(data[n:n+20]) for n in xrange(0, len(data), 20)]
+
+    def position(self, id):
+        """
+            return the position of the commit <id> in the list or -1
+        """
+        binsha = binascii.a2b_hex(id)
+        offset = self._data.find(binsha)
+        while offset != -1 and offset % 20 != 0:
+            offset = self._data.find(binsha, offset + 1)
+        if offset == -1:
+            return -1
+        return offset // 20
+
+class CommitListIndex(object):
+    """
+        a directory of CommitList files, stored as '<repository>/<id>'
+        where <id> is the commit the list starts from.
+
+        new lists are built from older lists of the same repository
+        whenever possible, so only the commits that are new since then
+        have to be listed by git.
+    """
+
+    def __init__(self, directory, lists=8):
+        self.directory = directory
+        self.lists = lists
+
+    def _directory(self, repository):
+        if not isinstance(repository, bytes):
+            repository = repository.encode('utf-8')
+        return os.path.join(self.directory, hashlib.sha1(repository).hexdigest())
+
+    def get(self, repository, id, build):
+        """
+            return the CommitList of the commits reachable from <id>. if it
+            doesn't exist yet, build(ids) is called with the ids of the
+            known lists of the repository (newest first). it has to return
+            a tuple (base, binshas) where base is the id of a known list
+            that shall be appended (or None) and binshas is an iterable of
+            the binary ids of the commits that are not in that list.
+        """
+        directory = self._directory(repository)
+        path = os.path.join(directory, id)
+        if os.path.exists(path):
+            return CommitList(path)
+
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+        # the known lists, newest first
+        known = []
+        for name in os.listdir(directory):
+            if name.endswith('.tmp'):
+                continue
+            try:
+                known.append((os.stat(os.path.join(directory, name)).st_mtime, name))
+            except OSError:
+                pass
+        known.sort(reverse=True)
+
+        base, binshas = build([name for mtime, name in known])
+
+        fd, temp = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                for binsha in binshas:
+                    fp.write(binsha)
+                if base is not None:
+                    with open(os.path.join(directory, base), 'rb') as older:
+                        shutil.copyfileobj(older, fp)
+            os.rename(temp, path)
+        except:
+            os.unlink(temp)
+            raise
+
+        # only keep the newest lists
+        for mtime, name in known[self.lists - 1:]:
+            try:
+                os.unlink(os.path.join(directory, name))
+            except OSError:
+                pass
+
+        return CommitList(path)
+
+_index = None
+_index_pid = None
+_index_lock = threading.Lock()
+_last_commit_index = None
+_commit_list_index = None
+_blame_index = None
+
+_warmed_up = set()
+_warm_up_lock = threading.Lock()
+
+def warm_up(base):
+    """
+        refresh the repository index of <base> in a background thread,
+        so that the first request doesn't have to scan all repositories.
+
+        the thread is only started once per process. servers that fork
+        their workers would not run it in the workers, so this should be
+        called by every worker (like before its first request).
+    """
+    with _warm_up_lock:
+        if (os.getpid(), base) in _warmed_up:
+            return None
+        _warmed_up.add((os.getpid(), base))
+
+    def run():
+        try:
+            get_repository_index().refresh(base, force=True)
+        except Exception as e:
+            logging.warning("could not scan the repositories in %s: %s", base, e)
+
+    thread = threading.Thread(target=run, name="pyggi-warm-up")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def get_repository_index():
+    """
+        return the repository index of this process. a forked process
+        creates an index of its own, so it never waits for refreshes that
+        were running in its parent.
+    """
+    global _index, _index_pid
+    with _index_lock:
+        if _index is not None and _index_pid == os.getpid():
+            return _index
+
+        from pyggi.lib.utils import get_index_directory
+
+        interval = 30
+        if config.has_option('index', 'interval'):
+            interval = config.getint('index', 'interval')
+
+        threads = 4
+        if config.has_option('index', 'scan_threads'):
+            threads = config.getint('index', 'scan_threads')
+
+        _index = RepositoryIndex(os.path.join(get_index_directory(), 'repositories.sqlite'), interval, threads)
+        _index_pid = os.getpid()
+        return _index
+
+def get_last_commit_index():
+    """
+        return the last commit index of this process
+    """
+    global _last_commit_index
+    if _last_commit_index is None:
+        from pyggi.lib.utils import get_index_directory
+        _last_commit_index = LastCommitIndex(os.path.join(get_index_directory(), 'last_commits.sqlite'))
+    return _last_commit_index
+
+def get_commit_list_index():
+    """
+        return the commit list index of this process
+    """
+    global _commit_list_index
+    if _commit_list_index is None:
+        from pyggi.lib.utils import get_index_directory
+        _commit_list_index = CommitListIndex(os.path.join(get_index_directory(), 'commits'))
+    return _commit_list_index
+
+def get_blame_index():
+    """
+        return the blame index of this process
+    """
+    global _blame_index
+    if _blame_index is None:
+        from pyggi.lib.utils import get_index_directory
+        _blame_index = BlameIndex(os.path.join(get_index_directory(), 'blames.sqlite'))
+    return _blame_index
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+"""
+    :copyright: (c) 2011 by Tobias Heinzen
+    :license: BSD, see LICENSE for more details
+"""
+
+import os, os.path
+import threading
+from pyggi.lib.lru import LRUCache
+
+def git_dir(path):
+    """
+        return the git directory of a repository, which is the
+        path itself for bare repositories and '<path>/.git' otherwise
+    """
+    dotgit = os.path.join(path, '.git')
+    if os.path.isdir(dotgit):
+        return dotgit
+    return path
+
+def repository_state(path):
+    """
+        return a cheap fingerprint of the state of a repository. the
+        fingerprint is composed of the modification times of the files
+        and directories git touches when references change, so it
+        changes whenever a branch or tag is created, updated or deleted.
+    """
+    base = git_dir(path)
+    state = []
+    for name in ['', 'HEAD', 'packed-refs', 'refs/heads', 'refs/tags']:
+        try:
+            state.append(os.stat(os.path.join(base, name)).st_mtime)
+        except OSError:
+            state.append(None)
+    return tuple(state)
+
+class RepositoryPool(object):
+    """
+        a bounded pool of open repository handles keyed by the path
+        of the repository.
+
+        every thread gets its own set of handles (the underlying git
+        processes are not thread safe), which is limited to <size>
+        handles and evicted in least recently used order. a handle is
+        reopened when the state of the repository changed on disk.
+    """
+
+    def __init__(self, factory, size=32):
+        self.factory = factory
+        self.size = size
+        self._local = threading.local()
+
+    def _handles(self):
+        handles = getattr(self._local, 'handles', None)
+        if handles is None:
+            handles = LRUCache(self.size, on_evict=lambda path, entry: self._close(entry[1]))
+            self._local.handles = handles
+        return handles
+
+    @staticmethod
+    def _close(handle):
+        close = getattr(handle, 'close', None)
+        if close is not None:
+            close()
+
+    def get(self, path):
+        handles = self._handles()
+        state = repository_state(path)
+
+        entry = handles.get(path)
+        if entry is not None:
+            if entry[0] == state:
+                return entry[1]
+
+            # repository changed on disk: throw away the old handle
+            handles.pop(path)
+            self._close(entry[1])
+
+        handle = self.factory(path)
+        handles.set(path, (state, handle))
+        return handle
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+"""
+    :copyright: (c) 2011 by Tobias Heinzen
+    :license: BSD, see LICENSE for more details
+"""
+
+import os, os.path
+import re
+import zlib
+from pyggi.lib.lru import LRUCache
+
+sha_regex = re.compile('^[0-9a-f]{40}$')
+
+# the places where git looks for a short reference name (see
+# git-rev-parse(1), "SPECIFYING REVISIONS")
+_ref_rules = ['%s', 'refs/%s', 'refs/tags/%s', 'refs/heads/%s', 'refs/remotes/%s', 'refs/remotes/%s/HEAD']
+
+# parsed packed-refs files, keyed by git directory
+_packed = LRUCache(256)
+
+def _valid_name(name):
+    if not name or name.startswith('/') or name.endswith('/') or name.endswith('.lock'):
+        return False
+    if '..' in name or '//' in name or '\\' in name:
+        return False
+    for c in name:
+        if c in ' ~^:?*[' or ord(c) < 32:
+            return False
+    return True
+
+def packed_refs(git_dir):
+    """
+        return a tuple (refs, peeled, fully_peeled) of the references
+        stored in the 'packed-refs' file of a repository. refs maps
+        reference names to ids, peeled maps the names of annotated tags
+        to the id of the commit they point to. fully_peeled is True if
+        git recorded every peelable reference in peeled.
+
+        the file is only parsed again if it changed on disk.
+    """
+    path = os.path.join(git_dir, 'packed-refs')
+    try:
+        st = os.stat(path)
+    except OSError:
+        return ({}, {}, True)
+
+    stamp = (st.st_mtime, st.st_size)
+    entry = _packed.get(git_dir)
+    if entry is not None and entry[0] == stamp:
+        return entry[1]
+
+    refs = {}
+    peeled = {}
+    fully_peeled = False
+    last = None
+    with open(path, 'rb') as fp:
+        for line in fp:
+            line = line.decode('utf-8', 'replace').rstrip('\n')
+            if line.startswith('#'):
+                fully_peeled = 'fully-peeled' in line.split()
+            elif line.startswith('^'):
+                if last is not None:
+                    peeled[last] = line[1:41]
+            elif len(line) > 41:
+                last = line[41:]
+                refs[last] = line[:40]
+
+    result = (refs, peeled, fully_peeled)
+    _packed.set(git_dir, (stamp, result))
+    return result
+
+def loose_ref(git_dir, name):
+    """
+        return the content of the loose reference <name> (either an id
+        or 'ref: <target>' for symbolic references), or None
+    """
+    try:
+        with open(os.path.join(git_dir, name), 'rb') as fp:
+            data = fp.read(512).decode('utf-8', 'replace').strip()
+    except (IOError, OSError):
+        return None
+
+    if data.startswith('ref:') or sha_regex.match(data[:40]):
+        return data
+    return None
+
+def peel_loose(git_dir, sha, depth=5):
+    """
+        follow annotated tags stored as loose objects down to the commit
+        they point to. returns the id of the commit, or None if an object
+        is not available as loose object (it's packed)
+    """
+    while depth > 0:
+        path = os.path.join(git_dir, 'objects', sha[:2], sha[2:])
+        try:
+            with open(path, 'rb') as fp:
+                data = zlib.decompressobj().decompress(fp.read(), 512)
+        except (IOError, OSError, zlib.error):
+            return None
+
+        header, _, body = data.partition(b'\0')
+        if header.startswith(b'commit '):
+            return sha
+        if not header.startswith(b'tag ') or not body.startswith(b'object '):
+            return None
+
+        sha = body[7:47].decode('ascii')
+        depth -= 1
+    return None
+
+def _lookup(git_dir, name, depth=5):
+    """
+        return (full name, id) of reference <name>, where name is a
+        fully qualified reference name (like 'refs/heads/master')
+    """
+    if depth == 0:
+        return None
+
+    data = loose_ref(git_dir, name)
+    if data is not None:
+        if data.startswith('ref:'):
+            return _lookup(git_dir, data[4:].strip(), depth - 1)
+        return (name, data[:40])
+
+    refs = packed_refs(git_dir)[0]
+    if name in refs:
+        return (name, refs[name])
+    return None
+
+def resolve(git_dir, name):
+    """
+        resolve the reference <name> to the id of the commit it points
+        to, by only looking at the reference files of the repository.
+
+        returns None if the reference does not exist or can't be
+        resolved without reading packed objects. callers should fall
+        back to asking git in that case.
+    """
+    if not _valid_name(name):
+        return None
+
+    for rule in _ref_rules:
+        if rule == '%s' and not (name.startswith('refs/') or name.replace('_', '').isupper()):
+            # only special references like HEAD live at the top
+            # of the git directory
+            continue
+        found = _lookup(git_dir, rule % name)
+        if found is not None:
+            break
+    else:
+        return None
+
+    fullname, sha = found
+    if not fullname.startswith('refs/tags/'):
+        # branches, remotes and HEAD always point to commits
+        return sha
+
+    # tags can be annotated, peel them
+    refs, peeled, fully_peeled = packed_refs(git_dir)
+    if refs.get(fullname) == sha:
+        if fullname in peeled:
+            return peeled[fullname]
+        if fully_peeled:
+            return sha
+    return peel_loose(git_dir, sha)
+
+# listings of all branches and tags, keyed by git directory
+_listings = LRUCache(256)
+
+def refs_state(git_dir):
+    """
+        return a fingerprint of all references of a repository. it changes
+        whenever a branch or tag is created, updated or deleted (git
+        replaces loose references by renaming, which touches the directory).
+    """
+    state = []
+    try:
+        st = os.stat(os.path.join(git_dir, 'packed-refs'))
+        state.append(('packed-refs', st.st_mtime, st.st_size))
+    except OSError:
+        state.append(('packed-refs', None, None))
+
+    for name in ['refs/heads', 'refs/tags']:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(git_dir, name)):
+            try:
+                state.append((dirpath, os.stat(dirpath).st_mtime, None))
+            except OSError:
+                pass
+    return tuple(state)
+
+def _loose_refs(git_dir, prefix):
+    result = {}
+    base = os.path.join(git_dir, prefix)
+    for dirpath, dirnames, filenames in os.walk(base):
+        for filename in filenames:
+            if filename.endswith('.lock'):
+                continue
+            name = os.path.relpath(os.path.join(dirpath, filename), base).replace(os.sep, '/')
+            found = _lookup(git_dir, prefix + '/' + name)
+            if found is not None:
+                result[name] = found[1]
+    return result
+
+def listing(git_dir, peel=None):
+    """
+        return a tuple (branches, tags) of dictionaries that map the names
+        of all branches and tags to the id of the commit they point to.
+
+        annotated tags are peeled with the '^{}' entries of 'packed-refs' or
+        by reading loose tag objects. tags that can't be peeled that way are
+        given to <peel>, which has to return the id of the commit or None.
+
+        the result is shared and only computed again if the references
+        changed on disk, so it must not be modified.
+    """
+    state = refs_state(git_dir)
+    entry = _listings.get(git_dir)
+    if entry is not None and entry[0] == state:
+        return entry[1]
+
+    refs, peeled, fully_peeled = packed_refs(git_dir)
+
+    branches = {}
+    tags = {}
+    unpeeled = {}
+    for name, sha in refs.items():
+        if name.startswith('refs/heads/'):
+            branches[name[11:]] = sha
+        elif name.startswith('refs/tags/'):
+            if name in peeled:
+                tags[name[10:]] = peeled[name]
+            elif fully_peeled:
+                tags[name[10:]] = sha
+            else:
+                unpeeled[name[10:]] = sha
+
+    # loose references take precedence over packed ones
+    branches.update(_loose_refs(git_dir, 'refs/heads'))
+    for name, sha in _loose_refs(git_dir, 'refs/tags').items():
+        tags.pop(name, None)
+        unpeeled[name] = sha
+
+    for name, sha in unpeeled.items():
+        commit = peel_loose(git_dir, sha)
+        if commit is None and peel is not None:
+            commit = peel(sha)
+        if commit is not None:
+            tags[name] = commit
+
+    result = (branches, tags)
+    _listings.set(git_dir, (state, result))
+    return result
+
+def _decorate(git_dir, peel):
+    branches, tags = listing(git_dir, peel)
+
+    # the decorations belong to the listing they were computed from
+    entry = _listings.get((git_dir, 'decorations'))
+    if entry is not None and entry[0] is branches:
+        return entry[1]
+
+    result = {}
+    for names in [branches, tags]:
+        for name in sorted(names):
+            result.setdefault(names[name], []).append(name)
+
+    result = (result, set(branches.values()), set(tags.values()))
+    _listings.set((git_dir, 'decorations'), (branches, result))
+    return result
+
+def decorations(git_dir, peel=None):
+    """
+        return a dictionary that maps the id of every commit that is
+        pointed to by a branch or tag to the list of names of those
+        branches and tags (branches first). see listing().
+    """
+    return _decorate(git_dir, peel)[0]
+
+def decorated(git_dir, peel=None):
+    """
+        return a tuple of two sets (branches, tags), containing the ids of
+        the commits that are pointed to by a branch or a tag respectively.
+        see listing().
+    """
+    return _decorate(git_dir, peel)[1:]
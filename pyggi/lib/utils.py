@@ -5,29 +5,7 @@
     :license: BSD, see LICENSE for more details
 """
 
-from flask import current_app
 from pyggi.lib.config import config
-import logging
-
-class DummyCache(object):
-    def get(*args, **kwargs):
-        pass
-    def set(*args, **kwargs):
-        pass
-
-if not (config.has_option('cache', 'enabled') and config.getboolean('cache', 'enabled')):
-    cache = DummyCache()
-else:
-    if current_app.debug:
-        from werkzeug.contrib.cache import SimpleCache
-        cache = SimpleCache()
-    else:
-        try:
-            from werkzeug.contrib.cache import MemcachedCache
-            cache = MemcachedCache([x.strip() for x in config.get('cache', 'uris').split(",") if not len(x.strip()) == 0])
-        except:
-            cache = DummyCache()
-            logging.critical("could not connect to memcache daemon - disabling caching")
 
 def get_clone_urls():
     from flask import request
@@ -41,4 +19,19 @@ def get_repository_path(name):
     import os
     return os.path.join(get_repository_base(), name)
 
+def get_index_directory():
+    import os, os.path, tempfile
+    if config.has_option('index', 'directory'):
+        path = config.get('index', 'directory')
+    else:
+        path = os.path.join(tempfile.gettempdir(), 'pyggi')
+
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # somebody else might have created it in the meantime
+            if not os.path.isdir(path):
+                raise
+    return path
 
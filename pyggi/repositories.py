@@ -12,24 +12,96 @@ import logging
 from pyggi.lib.decorators import templated, cached
 from pyggi.lib.repository import EmptyRepositoryError, RepositoryError
 from pyggi.lib.repository.gitr import GitRepository
+from pyggi.lib.repository import refs
+from pyggi.lib.repository.index import get_repository_index
+from pyggi.lib.archive import get_archive_cache
 from flask import Blueprint, redirect, url_for, request
 from pyggi.lib.utils import get_repository_base, get_repository_path
+from pyggi.lib.config import config
 
 frontend = Blueprint('repos', __name__)
 get = functools.partial(frontend.route, methods=['GET'])
 post = functools.partial(frontend.route, methods=['POST'])
 
-def cache_keyfn(prefix, additional_fields=[]):
-    def test(*args, **kwargs):
-        id = GitRepository.resolve_ref(get_repository_path(kwargs['repository']), kwargs['tree'])
-
+def get_refs_version(repository):
+    """
+        return a string that changes whenever the references of <repository>
+        change: either on disk, or when a hook announced a change (see
+        refs_changed)
+    """
+    import hashlib
+    from pyggi.lib.cache import get_cache
+    from pyggi.lib.repository.pool import git_dir
+
+    state = refs.refs_state(git_dir(get_repository_path(repository)))
+    generation = get_cache().get('refs-generation-' + repository, local=False) or 0
+    return "%s.%d" % (hashlib.sha1(repr(state)).hexdigest()[:12], generation)
+
+def cache_keyfn(prefix, additional_fields=[], additional_values=[], depends_on_refs=False):
+    """
+        return a function that computes the cache key of a view.
+
+        a page of an url that names a commit by its full id never changes,
+        so its key only contains that id. the pages of all other urls show
+        the name of the tree and mark branches and tags, so their key
+        contains the name, the id it resolves to and the version of the
+        references. pages that show references (like the list of branches)
+        give <depends_on_refs>, so their key always contains the version
+        of the references.
+
+        <additional_values> are the names of request values that are part
+        of the key, or functions that return such a part.
+    """
+    def immutable(kwargs):
+        return not depends_on_refs and refs.sha_regex.match(kwargs['tree']) is not None
+
+    def parameters(kwargs):
         path = ""
         for field in additional_fields:
             path = path + "-" + kwargs[field]
+        for value in additional_values:
+            if callable(value):
+                path = path + "-" + value()
+            else:
+                path = path + "-" + request.values.get(value, "")
+        return path
 
-        if id is not None:
-            return prefix + "-" + kwargs['repository'] + "-" + id + path
-        return None
+    def test(*args, **kwargs):
+        id = GitRepository.resolve_ref(get_repository_path(kwargs['repository']), kwargs['tree'])
+        if id is None:
+            return None
+
+        if immutable(kwargs):
+            return prefix + "-" + kwargs['repository'] + "-" + id + parameters(kwargs)
+        return prefix + "-" + kwargs['repository'] + "-" + id + "-@" + kwargs['tree'] + parameters(kwargs) + \
+            "-" + get_refs_version(kwargs['repository'])
+
+    def stale_key(*args, **kwargs):
+        # the last version of a page of an url that doesn't name a commit
+        # can be shown while the current version is computed
+        if immutable(kwargs):
+            return None
+        return prefix + "-" + kwargs['repository'] + "-@" + kwargs['tree'] + parameters(kwargs)
+
+    def cache_control(*args, **kwargs):
+        if immutable(kwargs):
+            return "public, max-age=31536000, immutable"
+        return "public, no-cache"
+
+    def last_modified(*args, **kwargs):
+        if depends_on_refs:
+            return None
+        path = get_repository_path(kwargs['repository'])
+        id = GitRepository.resolve_ref(path, kwargs['tree'])
+        if id is None:
+            return None
+
+        import datetime
+        return datetime.datetime.utcfromtimestamp(GitRepository.open(path).committed_date(id))
+
+    test.cache_control = cache_control
+    test.last_modified = last_modified
+    test.stale_key = stale_key
     return test
 
 @frontend.errorhandler(EmptyRepositoryError)
@@ -40,29 +112,72 @@ def error_empty(error):
 def error_repository(error):
     return redirect(url_for('base.not_found'))
 
+def get_page():
+    try:
+        return int(request.values['p'])
+    except:
+        return 0
+
+def get_page_size():
+    size = 50
+    if config.has_option('index', 'page_size'):
+        size = config.getint('index', 'page_size')
+
+    try:
+        size = int(request.values['size'])
+    except:
+        pass
+    return min(max(size, 1), 500)
+
 @get("/")
 @templated("repositories.xhtml")
 def index():
-    # compute the names of repositories
-    try:
-        dirnames = os.walk(get_repository_base()).next()[1]
-    except StopIteration:
-        logging.warning("repository base %s does not exist", dirnames)
-        return dict(repositories=[])
-
-    paths = (get_repository_path(name) for name in dirnames)
-    paths = (path for path in paths if GitRepository.isRepository(path))
+    page = max(get_page(), 0)
+    size = get_page_size()
+    sort = request.values.get('sort', 'name')
+    if sort not in ['name', 'updated']:
+        sort = 'name'
+    prefix = request.values.get('q', '').strip()
+
+    base = get_repository_base()
+    if os.path.isdir(base):
+        total, repositories = get_repository_index().query(base, sort, prefix, page*size, size)
+    else:
+        logging.warning("repository base %s does not exist", base)
+        total, repositories = 0, []
+
+    if request.values.get('format') == 'json':
+        from flask import jsonify
+        return jsonify(
+            total=total,
+            page=page,
+            size=size,
+            repositories=[
+                dict(
+                    name=repo.name,
+                    description=repo.description,
+                    is_empty=repo.is_empty,
+                    head=repo.head,
+                    last_date=repo.last_date,
+                    last_author=repo.last_author,
+                    url=url_for('.repository', repository=repo.name, _external=True)
+                ) for repo in repositories
+            ]
+        )
 
     return dict(
-        repositories=[
-            GitRepository(repository=path, force=True) for path in paths
-        ]
+        repositories=repositories,
+        page=page,
+        size=size,
+        sort=sort,
+        prefix=prefix,
+        max_pages=max(total - 1, 0) // size
     )
 
 @get("/<repository>/")
 @templated("detail.xhtml")
 def repository(repository):
-    repo = GitRepository(repository=get_repository_path(repository))
+    repo = GitRepository.open(get_repository_path(repository))
     return dict(
         repository=repo
     )
@@ -70,7 +185,7 @@ def repository(repository):
 @get("/<repository>/empty/")
 @templated("empty.xhtml")
 def empty(repository):
-    repo = GitRepository(repository=get_repository_path(repository), force=True)
+    repo = GitRepository.open(get_repository_path(repository), force=True)
 
     # if not really empty, then redirect to overview
     if not repo.is_empty:
@@ -80,27 +195,57 @@ def empty(repository):
         repository=repo
     )
 
+@post("/<repository>/refs-changed")
+def refs_changed(repository):
+    """
+        to be called by a post-receive hook: the references of the
+        repository changed, so all pages that show them are outdated.
+        the hook has to send the configured [cache] refs_secret, or has
+        to run on the same host if there is none.
+    """
+    from flask import current_app
+    from pyggi.lib.cache import get_cache
+
+    if config.has_option('cache', 'refs_secret'):
+        import hmac
+        secret = request.values.get('secret', '')
+        allowed = hmac.compare_digest(secret.encode('utf-8'), config.get('cache', 'refs_secret').encode('utf-8'))
+    else:
+        allowed = request.remote_addr in ['127.0.0.1', '::1']
+    if not allowed:
+        return current_app.response_class("forbidden\n", status=403, mimetype='text/plain')
+
+    path = get_repository_path(repository)
+    if not GitRepository.isRepository(path):
+        return redirect(url_for('base.not_found'))
+
+    # several hooks might announce changes at the same time
+    cache = get_cache()
+    key = 'refs-generation-' + repository
+    cache.add(key, 0, timeout=0)
+    cache.inc(key)
+
+    # the repository listing shows the last commits as well
+    get_repository_index().update(get_repository_base(), repository)
+
+    return current_app.response_class("ok\n", mimetype='text/plain')
+
 @get("/<repository>/overview/<tree>/")
-@cached(cache_keyfn('overview'))
+@cached(cache_keyfn('overview', depends_on_refs=True))
 @templated("overview.xhtml")
 def overview(repository, tree):
-    repo = GitRepository(repository=get_repository_path(repository))
+    repo = GitRepository.open(get_repository_path(repository))
 
     return dict(
         repository=repo,
         treeid=tree
     )
 
-def get_page():
-    try:
-        return int(request.values['p'])
-    except:
-        return 0
-
 @get("/<repository>/shortlog/<tree>/")
+@cached(cache_keyfn('shortlog', [], ['p', 'after'], depends_on_refs=True))
 @templated("shortlog.xhtml")
 def shortlog(repository, tree):
-    repo = GitRepository(repository=get_repository_path(repository))
+    repo = GitRepository.open(get_repository_path(repository))
     count = repo.commit_count(tree)
     page = get_page()
 
@@ -110,99 +255,335 @@ def shortlog(repository, tree):
 
     # upper limit
     if page*10 > count:
-        page = count / 10
+        page = count // 10
+    skip = page*10
+
+    # a page can also start after a given commit, which stays
+    # the same when new commits arrive
+    after = request.values.get('after')
+    if after is not None and refs.sha_regex.match(after) is not None:
+        position = repo.commit_position(tree, after)
+        if position >= 0:
+            skip = position + 1
+            page = skip // 10
 
     return dict(
         repository=repo,
         treeid=tree,
         page = page,
-        max_pages = count / 10
+        skip = skip,
+        max_pages = count // 10
     )
 
+def show_last_commits():
+    if config.has_option('index', 'last_commits'):
+        return config.getboolean('index', 'last_commits')
+    return True
+
 @get("/<repository>/tree/<tree>/")
-@cached(cache_keyfn('browse'))
+@cached(cache_keyfn('browse', depends_on_refs=True))
 @templated("browse.xhtml")
 def browse(repository, tree):
-    repo = GitRepository(repository=get_repository_path(repository))
+    repo = GitRepository.open(get_repository_path(repository))
 
     return dict(
         repository=repo,
         treeid=tree,
-        browse=True
+        browse=True,
+        show_last_commits=show_last_commits()
     )
 
 @get("/<repository>/tree/<tree>/<path:path>/")
-@cached(cache_keyfn('tree', ['path']))
+@cached(cache_keyfn('tree', ['path'], depends_on_refs=True))
 @templated("browse.xhtml")
 def browse_sub(repository, tree, path):
-    repo = GitRepository(repository=get_repository_path(repository))
+    repo = GitRepository.open(get_repository_path(repository))
 
     return dict(
         repository=repo,
         treeid=tree,
         breadcrumbs=path.split("/"),
-        browse=True
+        browse=True,
+        show_last_commits=show_last_commits()
     )
 
 @get("/<repository>/commit/<tree>/")
 @cached(cache_keyfn('commit'))
-@templated("commit.xhtml")
+@templated("commit.xhtml", stream=True)
 def commit(repository, tree):
-    repo = GitRepository(repository=get_repository_path(repository))
+    repo = GitRepository.open(get_repository_path(repository))
+
+    # the page is streamed, fail before it's started
+    repo.commit(tree)
+    max_files, max_lines = get_diff_limits()
+
+    return dict(
+        repository=repo,
+        treeid=tree,
+        max_files=max_files,
+        max_lines=max_lines
+    )
+
+def get_diff_limits():
+    """
+        return a tuple (max_files, max_lines): the commit page shows the
+        patches of at most max_files files with max_lines lines in total
+    """
+    max_files = 50
+    if config.has_option('diff', 'max_files'):
+        max_files = config.getint('diff', 'max_files')
+
+    max_lines = 5000
+    if config.has_option('diff', 'max_lines'):
+        max_lines = config.getint('diff', 'max_lines')
+
+    return (max_files, max_lines)
+
+@get("/<repository>/patch/<tree>/<path:path>")
+@cached(cache_keyfn('patch', ['path']))
+@templated("patch.xhtml")
+def patch(repository, tree, path):
+    repo = GitRepository.open(get_repository_path(repository))
+
+    diff = repo.commit(tree).patch(path)
+    if diff is None:
+        raise RepositoryError("Commit '%s' did not change '%s'" % (tree, path))
 
     return dict(
         repository=repo,
         treeid=tree,
+        diff=diff
     )
 
+def get_blob_limits():
+    """
+        return a tuple (max_size, window): blobs larger than max_size
+        bytes are only offered for download, and the blob page shows
+        at most window lines at once
+    """
+    max_size = 10240
+    if config.has_option('blob', 'max_size'):
+        max_size = config.getint('blob', 'max_size')
+
+    window = 1000
+    if config.has_option('blob', 'window'):
+        window = config.getint('blob', 'window')
+
+    return (max_size * 1024, window)
+
+def get_line_window(window):
+    """
+        return a tuple (start, stop) of the lines the client asked for
+        with '?lines=<first>-<last>' (1-based, both included). the window
+        is at most <window> lines long.
+    """
+    try:
+        first, last = request.values['lines'].split('-', 1)
+        start = max(int(first) - 1, 0)
+        stop = int(last)
+    except:
+        start, stop = 0, window
+
+    if stop <= start or stop - start > window:
+        stop = start + window
+    return (start, stop)
+
+def get_line_window_key():
+    # every way of asking for the same lines shares the cached page
+    return "%d-%d" % get_line_window(get_blob_limits()[1])
+
 @get("/<repository>/blob/<tree>/<path:path>")
-@cached(cache_keyfn('blob', ['path']))
-@templated("blob.xhtml")
+@cached(cache_keyfn('blob', ['path'], [get_line_window_key]))
+@templated("blob.xhtml", stream=True)
 def blob(repository, tree, path):
-    repo = GitRepository(repository=get_repository_path(repository))
+    repo = GitRepository.open(get_repository_path(repository))
+    repo.blob('/'.join([tree, path]))
+    max_size, window = get_blob_limits()
+    start, stop = get_line_window(window)
 
     return dict(
         repository=repo,
         treeid=tree,
-        breadcrumbs=path.split("/")
+        breadcrumbs=path.split("/"),
+        history_size=10,
+        max_size=max_size,
+        window=window,
+        start=start,
+        stop=stop,
+        previous=max(start - window, 0)
+    )
+
+@get("/<repository>/history/<tree>/<path:path>")
+@templated("history.xhtml")
+def history(repository, tree, path):
+    repo = GitRepository.open(get_repository_path(repository))
+
+    # the page starts after the last commit of the previous
+    # page, which stays the same when new commits arrive
+    after = request.values.get('after')
+    if after is not None and refs.sha_regex.match(after) is None:
+        after = None
+
+    return dict(
+        repository=repo,
+        treeid=tree,
+        breadcrumbs=path.split("/"),
+        after=after,
+        history_size=50
     )
 
 @get("/<repository>/blame/<tree>/<path:path>")
 @cached(cache_keyfn('blame', ['path']))
-@templated("blame.xhtml")
+@templated("blame.xhtml", stream=True)
 def blame(repository, tree, path):
-    repo = GitRepository(repository=get_repository_path(repository))
+    repo = GitRepository.open(get_repository_path(repository))
+    repo.blob('/'.join([tree, path]))
 
     return dict(
         repository=repo,
         treeid=tree,
-        breadcrumbs=path.split("/")
+        breadcrumbs=path.split("/"),
+        max_size=get_blob_limits()[0]
     )
 
+@get("/<repository>/blame-incremental/<tree>/<path:path>")
+def blame_incremental(repository, tree, path):
+    repo = GitRepository.open(get_repository_path(repository))
+
+    # the response is streamed, fail before it's started
+    repo.blob('/'.join([tree, path]))
+    blame = repo.blame_incremental('/'.join([tree, path]))
+
+    # every group of lines is sent as soon as git found its origin, one
+    # JSON object per line, so a page can fill in the blame while it's
+    # still computed
+    import json
+    def generate():
+        for commit, line, count in blame:
+            yield json.dumps(dict(
+                id=commit.id,
+                author=commit.author.name,
+                summary=commit.summary,
+                line=line + 1,
+                count=count
+            )) + "\n"
+
+    from flask import current_app
+    return current_app.response_class(generate(), mimetype='application/x-ndjson')
+
+def get_byte_range(size):
+    """
+        return a tuple (start, stop) for the byte range the client asked
+        for with a 'Range' header, None if the whole content shall be sent,
+        or False if the requested range can't be satisfied
+    """
+    header = request.headers.get('Range')
+    if not header:
+        return None
+
+    # only single ranges are supported, everything else
+    # gets the whole content
+    import re
+    match = re.match(r'^bytes=(\d*)-(\d*)$', header.strip())
+    if match is None or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+
+    if first == '':
+        # suffix range: the last <last> bytes
+        if int(last) == 0:
+            return False
+        return (max(size - int(last), 0), size)
+
+    start = int(first)
+    stop = size
+    if last != '':
+        if int(last) < start:
+            return None
+        stop = min(int(last) + 1, size)
+
+    if start >= size:
+        return False
+    return (start, stop)
+
 @get("/<repository>/raw/<tree>/<path:path>")
-@cached(cache_keyfn('raw', ['path']))
 def raw(repository, tree, path):
-    repo = GitRepository(repository=get_repository_path(repository))
+    repo = GitRepository.open(get_repository_path(repository))
     blob = repo.blob('/'.join([tree, path]))
 
-    # create a response with the correct mime type
-    from flask import make_response
-    response = make_response(blob.data)
-    response.mimetype = blob.mime_type
+    from flask import current_app
+    response = current_app.response_class(mimetype=blob.mime_type)
+    response.headers['Accept-Ranges'] = 'bytes'
+
+    # the id of a blob is the hash of its content
+    response.set_etag(blob.id)
+    if refs.sha_regex.match(tree) is not None:
+        response.headers['Cache-Control'] = "public, max-age=31536000, immutable"
+    if request.if_none_match.contains(blob.id):
+        response.status_code = 304
+        return response
+
+    byte_range = None
+    if request.headers.get('If-Range', blob.id).strip('"') == blob.id:
+        byte_range = get_byte_range(blob.size)
+
+    if byte_range is False:
+        response.status_code = 416
+        response.headers['Content-Range'] = "bytes */%d" % blob.size
+        return response
+
+    if byte_range is None:
+        start, stop = 0, blob.size
+    else:
+        start, stop = byte_range
+        response.status_code = 206
+        response.headers['Content-Range'] = "bytes %d-%d/%d" % (start, stop - 1, blob.size)
+
+    # stream the data to the client, so large files
+    # never have to be held in memory
+    response.response = blob.stream(start, stop)
+    response.direct_passthrough = True
+    response.headers['Content-Length'] = str(stop - start)
     return response
 
-@get("/<repository>/download/<tree>")
-@cached(cache_keyfn('download'))
-def download(repository, tree):
-    repo = GitRepository(repository=get_repository_path(repository))
-    data = repo.archive(tree)
-
-    # create a response with the correct mime type
-    # and a better filename
-    from flask import make_response
-    response = make_response(data)
-    response.mimetype = 'application/x-tar'
-    response.headers['Content-Disposition'] = "attachment; filename=%s-%s.tar" % (repository, tree[:8])
+archive_mimetypes = {
+    'tar': 'application/x-tar',
+    'tar.gz': 'application/x-gzip',
+    'tgz': 'application/x-gzip',
+    'zip': 'application/zip',
+}
+
+@get("/<repository>/download/<tree>.zip", defaults=dict(format='zip'))
+@get("/<repository>/download/<tree>.tgz", defaults=dict(format='tgz'))
+@get("/<repository>/download/<tree>.tar.gz", defaults=dict(format='tar.gz'))
+@get("/<repository>/download/<tree>.tar", defaults=dict(format='tar'))
+@get("/<repository>/download/<tree>", defaults=dict(format='tar'))
+def download(repository, tree, format):
+    repo = GitRepository.open(get_repository_path(repository))
+    filename = "%s-%s.%s" % (repository, tree[:8], format)
+
+    # archives of a commit never change: serve them from the
+    # archive cache (if there is one) and create them only once
+    archive_cache = get_archive_cache()
+    id = GitRepository.resolve_ref(repo.path, tree)
+    if archive_cache is not None and id is not None:
+        from flask import send_file
+        path = archive_cache.get(repository, id, format, lambda: repo.archive(id, format))
+        return send_file(path,
+            mimetype=archive_mimetypes[format],
+            as_attachment=True,
+            attachment_filename=filename,
+            conditional=True
+        )
+
+    # the archive is streamed to the client while git creates it,
+    # so it never has to be held in memory
+    from flask import current_app
+    response = current_app.response_class(
+        repo.archive(tree, format),
+        mimetype=archive_mimetypes[format],
+        direct_passthrough=True
+    )
+    response.headers['Content-Disposition'] = "attachment; filename=%s" % filename
 
     return response
-